@@ -4,6 +4,9 @@
 # une fenêtre interactive, avec des sliders pour faire bouger les paramêtres 
 # et voir en temps réel le résultat de la différence de gaussiennes.
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2 as cv
@@ -49,6 +52,49 @@ def DoG(im,
 
 
 
+# Pour la fenêtre interactive, on découpe la DoG en étapes dont on garde les résultats en mémoire :
+# bouger un slider ne recalcule que les étapes qui dépendent de ce slider.
+# - les deux flous gaussiens dépendent de (kernel_shape, sigma) : gardés dans un cache LRU borné,
+#   donc bouger sigma_diff ne recalcule que le flou sup (le flou inf est déjà en cache)
+# - la DoG finie (différence + dernier flou) dépend de tous les paramètres sauf le seuil
+# - le masque ne dépend que de la DoG finie et du seuil : bouger le seuil ne fait que re-seuiller
+class DoGPipeline:
+    def __init__(self, im, cache_size=8):
+        self.im = im
+        self.cache_size = cache_size
+        self._blurs = OrderedDict()
+        self._DoGs = OrderedDict()
+
+    def _cached(self, cache, key, compute):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = cache[key] = compute()
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)   # on oublie le résultat utilisé le moins récemment
+        return value
+
+    def blur(self, kernel_shape, sigma):
+        return self._cached(self._blurs, (kernel_shape, sigma),
+                            lambda: cv.GaussianBlur(self.im, kernel_shape, sigmaX=sigma, sigmaY=sigma))
+
+    def DoG(self, kernel_shape, sigma_inf, sigma_sup, last_blur_kernel_shape, last_blur_sigma):
+        """
+        Renvoie le couple (DoG_im, max de DoG_im), avant seuillage.
+        """
+        def compute():
+            diff = self.blur(kernel_shape, sigma_inf) - self.blur(kernel_shape, sigma_sup)
+            DoG_im = cv.GaussianBlur(diff, last_blur_kernel_shape, last_blur_sigma)
+            return DoG_im, np.max(DoG_im)
+        return self._cached(self._DoGs, (kernel_shape, sigma_inf, sigma_sup, last_blur_kernel_shape, last_blur_sigma), compute)
+
+    def mask(self, kernel_shape, sigma_inf, sigma_sup, last_blur_kernel_shape, last_blur_sigma, tolerance_threshold):
+        # même résultat que la fonction DoG ci-dessus
+        DoG_im, max_DoG = self.DoG(kernel_shape, sigma_inf, sigma_sup, last_blur_kernel_shape, last_blur_sigma)
+        return (DoG_im > (max_DoG - tolerance_threshold)).astype(np.uint8)
+
+
+
 # Tout ce qui est dessous concerne la mise en place de 
 # la fenetre interactive (pas interessant à lire)
 if __name__ == "__main__":
@@ -66,8 +112,12 @@ if __name__ == "__main__":
     tolerance_threshold = 26000
     # -----------------------------
 
-    mask1 = DoG(im[0], kernel_shape, sigma_inf, sigma_sup, (0,0), last_blur_sigma, tolerance_threshold)
-    mask2 = DoG(im[3], kernel_shape, sigma_inf, sigma_sup, (0,0), last_blur_sigma, tolerance_threshold)
+    # les deux images affichées, avec leurs caches ; elles sont traitées en parallèle
+    # (OpenCV relâche le GIL pendant les flous)
+    pipelines = [DoGPipeline(im[0]), DoGPipeline(im[1])]
+    pool = ThreadPoolExecutor(max_workers=2)
+
+    mask1, mask2 = pool.map(lambda p: p.mask(kernel_shape, sigma_inf, sigma_sup, (0,0), last_blur_sigma, tolerance_threshold), pipelines)
 
     fig, ax = plt.subplots(1, 2, figsize=(11, 6))
     fig.suptitle("Cherche-t-on des points spéciaux de l'ordre du pixel ou des zones particulières plus grandes ?")
@@ -127,31 +177,36 @@ if __name__ == "__main__":
         valinit=kernel_shape[0],
     )
 
-    def update(val):
+    def compute(pipeline, params):
+        mask = pipeline.mask(*params)
+        contours, hierarchy = cv.findContours(mask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+        return mask, contours
+
+    def redraw():
         i = int(ksize_slider.val)
         kernel_shape = (i + (i%2==0),)*2
+        params = (kernel_shape, sigma_inf_slider.val, sigma_inf_slider.val + sigma_diff_slider.val,
+                  (0,0), last_blur_slider.val, threshold_slider.val)
+
+        (mask1, contours1), (mask2, contours2) = pool.map(lambda p: compute(p, params), pipelines)
 
-        mask1 = DoG(im[0], 
-                kernel_shape, sigma_inf_slider.val, sigma_inf_slider.val + sigma_diff_slider.val, 
-                (0,0), last_blur_slider.val, 
-                threshold_slider.val)    
-        contours1, hierarchy1 = cv.findContours(mask1, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
-        
         ax[0].set_title(f"DoG sur image 1 : {len(contours1)} composantes connexes")
         plot_im1.set_data(mask1)
-        
-        
-        mask2 = DoG(im[1], 
-                kernel_shape, sigma_inf_slider.val, sigma_inf_slider.val + sigma_diff_slider.val, 
-                (0,0), last_blur_slider.val, 
-                threshold_slider.val)
-        contours2, hierarchy2 = cv.findContours(mask2, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
-        
         ax[1].set_title(f"DoG sur image 2 : {len(contours2)} composantes connexes")
         plot_im2.set_data(mask2)
         
         fig.canvas.draw_idle()
 
+    # Un glissement de slider envoie une rafale d'événements : on ne recalcule qu'une fois la rafale
+    # terminée (pas d'événement depuis 150 ms), avec les dernières valeurs des sliders.
+    timer = fig.canvas.new_timer(interval=150)
+    timer.single_shot = True
+    timer.add_callback(redraw)
+
+    def update(val):
+        timer.stop()
+        timer.start()
+
     last_blur_slider.on_changed(update)
     sigma_inf_slider.on_changed(update)
     sigma_diff_slider.on_changed(update)
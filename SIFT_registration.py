@@ -1,84 +1,160 @@
+import argparse
+
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
 
-# On utilise la méthode Scale Invariant Feature Transform (SIFT) pour obtenir des points clé (keypoints) auxquels sont associés des descripteurs. 
-# A partir de ces points clé sur les deux images et leurs descripteurs, il est possible de trouver des correspondances sur les deux images. 
-
-# read images
-im_ref = str(input("Entrer le nom de l'image de référence : "))
-im_trans = str(input("Entrer le nom de l'image translatée : "))
-
-img1 = cv2.imread(im_ref)
-img2 = cv2.imread(im_trans)
-
-# On applique un flou gaussien léger pour atténuer le bruit éventuel de l'image
-img1 = cv2.GaussianBlur(img1, [0,0], 1.5)
-img2 = cv2.GaussianBlur(img2, [0,0], 1.5)
-
-img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-
-# Initialisation de la méthode SIFT
-sift = cv2.SIFT_create()
-
-keypoints_1, descriptors_1 = sift.detectAndCompute(img1,None)
-keypoints_2, descriptors_2 = sift.detectAndCompute(img2,None)
-
-# On fait correspondre les keypoints par méthode force brute
-bf = cv2.BFMatcher(cv2.NORM_L1, crossCheck=True)
-
-matches = bf.match(descriptors_1,descriptors_2)
-matches = sorted(matches, key = lambda x:x.distance)
-
-
-
-img3 = cv2.drawMatches(img1, keypoints_1, img2, keypoints_2, matches[:50], img2, flags=2)
-plt.imshow(img3),plt.show()
-
-# On récupère les paires de points associés sur les chaque image. 
-pairs = np.array([[keypoints_1[match.queryIdx].pt, keypoints_2[match.trainIdx].pt] for match in matches])
-
-# On récupère la translation en x et y pour chacun des points
-trans_mat = np.array([[pairs[i,1][0] - pairs[i,0][0], pairs[i,1][1] - pairs[i,0][1]] for i in range(len(pairs))])
-
-# On élimine les translations aberrantes, i.e celles qui sont trop éloignées de la moyenne. 
-avg_trans = np.average(trans_mat, axis = 0)
-std_trans = np.std(trans_mat, axis = 0) # écart-type
-
-
-non_ab_trans_mat = []
-for i in range(len(trans_mat)):
-    if np.abs(avg_trans[0] - trans_mat[i, 0]) < std_trans[0]:
-        if np.abs(avg_trans[1] - trans_mat[i, 1]) < std_trans[1]:
-            non_ab_trans_mat.append(trans_mat[i])
-non_ab_trans_mat = np.array(non_ab_trans_mat)
-
-# Clustering pour trouver la translation optimale dans l'espace des translations en 2D
-best_count = 0
-best_list = []
-opt_tr = np.zeros((2,))
-for tr in non_ab_trans_mat:
-    count = 0
-    list = []
-    for elt in non_ab_trans_mat:
-        if np.linalg.norm(tr - elt) < 10 :
-            count += 1
-            list.append(elt)
-    if count > best_count:
-        best_count = count
-        best_list = list
-        opt_tr = tr
-best_list = np.array(best_list)
-
-fig, ax = plt.subplots()
-circle = plt.Circle(opt_tr, 10, fill = False, edgecolor = 'red')
-ax.add_patch(circle)
-ax.scatter(non_ab_trans_mat[:, 0], non_ab_trans_mat[:, 1], marker='x')
-ax.set_xlabel("Translation selon x")
-ax.set_ylabel("Translation selon y")
-plt.show()
-
-print(f"Image de référence : {im_ref}")
-print(f"Image translatée : {im_trans}")
-print(f"la translation optimale est {np.round(np.average(best_list, axis = 0))}")
\ No newline at end of file
+import phase_correlation
+from preprocessing import Preprocessor
+from registration import Diagnostics, cluster_translations
+
+# On utilise la méthode Scale Invariant Feature Transform (SIFT) pour obtenir des points clé (keypoints) auxquels sont associés des descripteurs.
+# A partir de ces points clé sur les deux images et leurs descripteurs, il est possible de trouver des correspondances sur les deux images.
+
+# Le script s'importe aussi : sift_registration fait tout le calcul sans interaction (pas d'input(), pas de fenêtre),
+# et les figures sont, si on le demande, enregistrées dans un fichier. Utilisable dans un traitement par lot.
+# Attention au signe : la translation renvoyée est celle des keypoints, de la référence vers l'image translatée
+# (point de l'image translatée - point de la référence), l'opposé de celle de registration.find_translation.
+
+
+# On élimine les translations aberrantes, i.e celles qui sont trop éloignées de la moyenne :
+# on ne garde que celles à moins de n_sigmas écarts-types de la moyenne, selon x et selon y.
+# Le test est fait sur tout le tableau d'un coup (pas de boucle Python sur les translations).
+def sigma_clip(translations, n_sigmas=1.):
+    avg_trans = translations.mean(axis=0)
+    std_trans = translations.std(axis=0)  # écart-type
+    # (<= plutôt que < : si toutes les translations sont égales, l'écart-type est nul et on les garde toutes)
+    return translations[np.all(np.abs(translations - avg_trans) <= n_sigmas * std_trans, axis=1)]
+
+
+def sift_registration(ref, toTranslate, filenames=True, blur_sigma=1.5, radius=10., n_sigmas=1., plot=None,
+                      n_drawn_matches=50, return_diagnostics=False):
+    """
+    Translation entre l'image de référence ref et l'image translatée toTranslate, par SIFT : correspondances
+    des keypoints par force brute, élimination des translations aberrantes (sigma_clip), puis clustering dans
+    l'espace des translations (registration.cluster_translations : une grille de cases de côté radius / 4, au lieu de
+    comparer toutes les paires de translations).
+
+    ref, toTranslate : noms de fichier (filenames=True) ou numpy arrays 2D (8 ou 16 bits)
+
+    blur_sigma : écart-type du flou gaussien appliqué avant SIFT
+
+    radius : rayon (en pixels) du voisinage utilisé pour le clustering
+
+    n_sigmas : seuil de sigma_clip, en nombre d'écarts-types
+
+    plot : nom de fichier ou None ; si donné, y enregistre la figure des n_drawn_matches meilleures correspondances
+    et du nuage des translations gardées, avec le cluster retenu
+
+    return_diagnostics : si True, renvoie le couple (translation, diagnostics) (voir registration.Diagnostics),
+    avec les étapes "read", "blur", "detect", "match", "clip", "cluster" et "total"
+
+    Renvoie la translation (T_x, T_y) des keypoints de ref vers ceux de toTranslate (array d'entiers) :
+    ref[x,y] = toTranslate[x+T_x, y+T_y].
+    """
+    diagnostics = Diagnostics(enabled=return_diagnostics)
+    diagnostics.used_method = "sift"
+    preprocessor = Preprocessor()
+
+    with diagnostics.stage("total"):
+        keypoints, descriptors, images = [], [], []
+        # Initialisation de la méthode SIFT
+        sift = cv2.SIFT_create()
+        for name, im in (("ref", ref), ("toTranslate", toTranslate)):
+            if filenames:
+                with diagnostics.stage("read"):
+                    im = phase_correlation.read_image(im)
+            # On applique un flou gaussien léger pour atténuer le bruit éventuel de l'image
+            # (en float32 à pleine profondeur, puis ramené sur 8 bits pour SIFT, voir preprocessing.py)
+            with diagnostics.stage("blur"):
+                normalized = preprocessor.to_float32(im, normalize=True)
+                images.append(preprocessor.to_uint8(preprocessor.blur(normalized, blur_sigma, name="float32"), name=name))
+            with diagnostics.stage("detect"):
+                keypoints_k, descriptors_k = sift.detectAndCompute(images[-1], None)
+            if descriptors_k is None:
+                raise ValueError(f"aucun keypoint trouvé sur l'image {name}")
+            keypoints.append(keypoints_k)
+            descriptors.append(descriptors_k)
+
+        # On fait correspondre les keypoints par méthode force brute
+        with diagnostics.stage("match"):
+            bf = cv2.BFMatcher(cv2.NORM_L1, crossCheck=True)
+            matches = bf.match(descriptors[0], descriptors[1])
+            if not matches:
+                raise ValueError("aucune correspondance entre les keypoints des deux images")
+            # On récupère les paires de points associés sur chaque image, puis la translation en x et y pour chacune
+            indices = np.array([(match.queryIdx, match.trainIdx) for match in matches], dtype=np.intp)
+            points_1 = np.array([keypoint.pt for keypoint in keypoints[0]], dtype=np.float64)
+            points_2 = np.array([keypoint.pt for keypoint in keypoints[1]], dtype=np.float64)
+            trans_mat = points_2[indices[:,1]] - points_1[indices[:,0]]
+
+        with diagnostics.stage("clip"):
+            non_ab_trans_mat = sigma_clip(trans_mat, n_sigmas)
+
+        # Clustering pour trouver la translation optimale dans l'espace des translations en 2D
+        with diagnostics.stage("cluster"):
+            translation, cluster_size = cluster_translations(non_ab_trans_mat, radius)
+
+    if plot is not None:
+        save_plot(plot, images, keypoints, matches, non_ab_trans_mat, translation, radius, n_drawn_matches)
+
+    if not return_diagnostics:
+        return translation
+    diagnostics.n_keypoints_ref, diagnostics.n_keypoints = len(keypoints[0]), len(keypoints[1])
+    diagnostics.n_matches, diagnostics.cluster_size = len(matches), cluster_size
+    diagnostics.inlier_ratio = cluster_size / len(matches)
+    diagnostics.translation = translation
+    return translation, diagnostics
+
+
+def save_plot(filename, images, keypoints, matches, translations, translation, radius, n_drawn_matches=50):
+    """
+    Enregistre dans filename les meilleures correspondances et le nuage des translations, avec le cercle du cluster.
+    """
+    # Figure de matplotlib sans pyplot : aucune fenêtre n'est ouverte, même sans écran
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Circle
+
+    fig = Figure(figsize=(14, 6))
+    ax_matches, ax = fig.subplots(1, 2, gridspec_kw=dict(width_ratios=[2, 1]))
+
+    best_matches = sorted(matches, key=lambda x: x.distance)[:n_drawn_matches]
+    img3 = cv2.drawMatches(images[0], keypoints[0], images[1], keypoints[1], best_matches, None, flags=2)
+    ax_matches.imshow(img3)
+    ax_matches.set_axis_off()
+
+    ax.add_patch(Circle(translation, radius, fill=False, edgecolor='red'))
+    ax.scatter(translations[:, 0], translations[:, 1], marker='x')
+    ax.set_xlabel("Translation selon x")
+    ax.set_ylabel("Translation selon y")
+    ax.set_aspect("equal")
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Translation entre deux images par SIFT et clustering des translations")
+    parser.add_argument("ref", nargs="?", help="image de référence (demandée au clavier si absente)")
+    parser.add_argument("toTranslate", nargs="?", help="image translatée (demandée au clavier si absente)")
+    parser.add_argument("--plot", help="enregistre les figures dans ce fichier (png, pdf, ...)")
+    parser.add_argument("--radius", type=float, default=10.)
+    parser.add_argument("--blur-sigma", type=float, default=1.5)
+    parser.add_argument("--n-sigmas", type=float, default=1.)
+    parser.add_argument("--diagnostics", action="store_true", help="affiche le temps de chaque étape")
+    args = parser.parse_args(argv)
+
+    # read images
+    im_ref = args.ref or str(input("Entrer le nom de l'image de référence : "))
+    im_trans = args.toTranslate or str(input("Entrer le nom de l'image translatée : "))
+
+    translation, diagnostics = sift_registration(im_ref, im_trans, blur_sigma=args.blur_sigma, radius=args.radius,
+                                                 n_sigmas=args.n_sigmas, plot=args.plot, return_diagnostics=True)
+
+    print(f"Image de référence : {im_ref}")
+    print(f"Image translatée : {im_trans}")
+    print(f"la translation optimale est {translation}")
+    if args.diagnostics:
+        print(diagnostics)
+
+
+if __name__ == "__main__":
+    main()
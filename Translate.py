@@ -8,25 +8,24 @@ from matplotlib.image import imread
 # pixels noirs purs (couleur = 0) juste à côté de pixels blancs purs (couleur = 0xffff).  
 
 def locate_cross(im, visualization=None):
-    # pixels noirs
-    I_black, J_black = np.where(im == 0) # (on pourrait prendre une condition moins restrictive, c'est un paramètre à expérimenter)
+    # pixels noirs et blancs purs
+    black = im == 0 # (on pourrait prendre une condition moins restrictive, c'est un paramètre à expérimenter)
+    white = im == 0xffff
 
-    # parmi ces pixels, lesquels sont dans une zone très noire, mais contenant au moins un pixel blanc ? 
+    # parmi les pixels noirs, lesquels sont dans une zone très noire, mais contenant au moins un pixel blanc ? 
     # Ceux là appartiennent à coup sûr au motif. ("zone", "noir", "blanc" sont des notions expressément vagues)
-    I, J = [], []
-    for i,j in zip(I_black, J_black):
-        close_neighborhood = im[i-1:i+2, j-1:j+2]
-        great_neighborhood = im[i-6:i+6, j-6:j+6]
-        if (close_neighborhood == 0).sum() >= 7 and (great_neighborhood == 0xffff).any(): 
-            # La taille des zones, les couleurs retenues par les filtres et les seuils après filtrages sont des paramètres 
-            # sur lesquels on peut jouer. Il semble y avoir de la marge sur les valeurs acceptables (qui permettent de 
-            # bien caractériser les pixels du motif) grâce au contraste élevé entre le motif et le reste de l'image
-            I.append(i)
-            J.append(j)
+    # Les deux voisinages sont évalués d'un coup sur toute l'image (sommes sur des fenêtres glissantes), 
+    # les pixels hors de l'image comptent comme ni noirs ni blancs.
+    close_neighborhood = window_sum(black, 1, 2)    # nombre de pixels noirs dans le carré 3x3 centré sur le pixel
+    great_neighborhood = window_sum(white, 6, 6)    # nombre de pixels blancs dans le carré 12x12 autour du pixel
+    # La taille des zones, les couleurs retenues par les filtres et les seuils après filtrages sont des paramètres 
+    # sur lesquels on peut jouer. Il semble y avoir de la marge sur les valeurs acceptables (qui permettent de 
+    # bien caractériser les pixels du motif) grâce au contraste élevé entre le motif et le reste de l'image
+    I, J = np.where(black & (close_neighborhood >= 7) & (great_neighborhood > 0))
 
     # Bordure approximative du motifs (bounding box approximative)
-    mi, Mi = min(I), max(I)
-    mj, Mj = min(J), max(J)
+    mi, Mi = I.min(), I.max()
+    mj, Mj = J.min(), J.max()
 
     # Pour visualiser ce qu'il se passe (faire des plots)
     if visualization != None:
@@ -38,6 +37,19 @@ def locate_cross(im, visualization=None):
 
 
 
+# Somme des valeurs de mask (booléens) sur la fenêtre [i-before, i+after[ x [j-before, j+after[ pour chaque pixel (i,j),
+# calculée pour tous les pixels à la fois grâce à l'image intégrale (sommes cumulées) : 4 lectures par pixel,
+# quelle que soit la taille de la fenêtre. Hors de l'image, mask est considéré nul.
+def window_sum(mask, before, after):
+    h, w = mask.shape
+    integral = np.zeros((h + before + after + 1, w + before + after + 1), dtype=np.int32)
+    integral[before+1:before+1+h, before+1:before+1+w] = mask
+    integral = integral.cumsum(axis=0).cumsum(axis=1)
+    size = before + after
+    return integral[size:size+h, size:size+w] - integral[:h, size:size+w] - integral[size:size+h, :w] + integral[:h, :w]
+
+
+
 # Construction de la sous-image de référence :
 # on agrandit la bounding box approximative pour être sûr qu'elle contient le motif en (quasi-)entièreté. (étape pas très intéressante)
 def get_ref_rect(im, mi, Mi, mj, Mj):
@@ -57,52 +69,101 @@ def get_ref_rect(im, mi, Mi, mj, Mj):
 
 
 
-# Détermination de la translation optimale par méthode force brute à partir d'une bonne approximation : 
+# identification des pixels utilisés pour la comparaison dans une sous-image : la comparaison ne porte que sur
+# ces pixels filtrés (sensibilité des filtres est un paramètre), ici on ne retient que les pixels noirs purs et blancs purs.
+# On obtient une matrice "comparable" de 1 (noir), -1 (blanc) et 0 (le reste).
+def comparable(rect):
+    black_pixels_mask = (rect == 0).astype(np.int8)
+    white_pixels_mask = (rect == 0xffff).astype(np.int8) 
+    return black_pixels_mask - white_pixels_mask
+
+
+
+# Sous-image de référence préparée pour la comparaison : on la construit une seule fois par image de référence,
+# puis on la réutilise pour toutes les images à translater (les transformées de Fourier nécessaires à la 
+# corrélation sont gardées en mémoire pour chaque taille de zone de recherche rencontrée).
+class CrossTemplate:
+    def __init__(self, to_compare_ref_rect):
+        self.A = to_compare_ref_rect.astype(np.float64)
+        self.A2 = self.A**2
+        self.sum_A2 = self.A2.sum()
+        self._spectra = {}
+
+    def spectra(self, shape):
+        if shape not in self._spectra:
+            self._spectra[shape] = np.fft.rfft2(self.A, shape).conj(), np.fft.rfft2(self.A2, shape).conj()
+        return self._spectra[shape]
+
+
+
+# Corrélation (sans retournement) de chaque spectre de modèle avec l'image B : c[u,v] = somme A[p,q] B[p+u,q+v],
+# pour toutes les positions (u,v) où le modèle de taille (height, width) est entièrement dans B.
+def _correlate(spectrum, B_spectrum, shape, height, width):
+    c = np.fft.irfft2(B_spectrum * spectrum, shape)
+    return np.rint(c[:shape[0]-height+1, :shape[1]-width+1])
+
+
+
+# Distance (norme 1) entre la sous-image de référence du modèle template (CrossTemplate) et chaque sous-image de
+# taille (height, width) de B (matrice "comparable" de 1, 0 et -1) : pour des matrices de 1, 0 et -1,
+# |a - b| = a² + b² - ab - a²b², donc la distance s'écrit avec deux corrélations (A avec B, A² avec B²) et une somme
+# glissante de B², calculées par FFT. dist[u,v] est la distance à la sous-image de coin haut gauche (u,v).
+def l1_distances(template, B, height, width):
+    B = B.astype(np.float64)
+    B2 = B**2
+    shape = B.shape
+    spectrum_A, spectrum_A2 = template.spectra(shape)
+    corr_AB = _correlate(spectrum_A, np.fft.rfft2(B), shape, height, width)
+    corr_A2B2 = _correlate(spectrum_A2, np.fft.rfft2(B2), shape, height, width)
+
+    # somme de B² sur chaque fenêtre (image intégrale)
+    integral = np.pad(B2, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    sum_B2 = integral[height:, width:] - integral[:-height, width:] - integral[height:, :-width] + integral[:-height, :-width]
+
+    return template.sum_A2 + sum_B2 - corr_AB - corr_A2B2
+
+
+
+# Détermination de la translation optimale à partir d'une bonne approximation : 
 # on possède les locations approximatives des motifs de 2 photos, l'une étant considérée comme celle de référence,
 # donc on possède une première approximation de la transaltion recherchée, qu'on affine en la perturbant un peu.
-def optimal_translation(to_compare_ref_rect, height, width, top, left, im, visualization=False):
-    best_top, best_left = None, None
-    min_dist = 1e9
+#
+# Plutôt que de comparer la sous-image de référence à chaque sous-image perturbée une par une, on calcule la distance
+# pour toutes les perturbations d'un coup, par FFT (voir l1_distances).
+#
+# radius : demi-largeur de l'intervalle des perturbations. Si la meilleure perturbation est au bord de l'intervalle,
+# la vraie translation est peut-être au-delà : on double radius et on recommence (jusqu'à max_radius).
+def optimal_translation(to_compare_ref_rect, height, width, top, left, im, visualization=False, radius=10, max_radius=160):
+    template = to_compare_ref_rect if isinstance(to_compare_ref_rect, CrossTemplate) else CrossTemplate(to_compare_ref_rect)
+
+    while True:
+        # zone de recherche : toutes les positions du coin haut gauche entre top-radius et top+radius
+        # (resp. left), restreintes à celles où la sous-image est entièrement dans l'image
+        search_top, search_left = max(top - radius, 0), max(left - radius, 0)
+        search_bottom = min(top + radius + height, im.shape[0])
+        search_right = min(left + radius + width, im.shape[1])
+        region = im[search_top:search_bottom, search_left:search_right]
+        if region.shape[0] < height or region.shape[1] < width:
+            return None, None
+
+        dist = l1_distances(template, comparable(region), height, width)
+
+        # meilleure perturbation (à égalité, la première dans l'ordre des lignes puis des colonnes)
+        i, j = np.unravel_index(dist.argmin(), dist.shape)
+        best_top, best_left = search_top + i, search_left + j
+
+        # la meilleure perturbation touche-t-elle le bord de l'intervalle (et l'intervalle peut-il encore grandir) ?
+        on_border = (best_top == top - radius and best_top > 0) or (best_top == top + radius and best_top + height < im.shape[0]) \
+                 or (best_left == left - radius and best_left > 0) or (best_left == left + radius and best_left + width < im.shape[1])
+        if not on_border or 2 * radius > max_radius:
+            break
+        radius *= 2
 
     if visualization:
-        fig.suptitle("Faut désactiver les animations si on veut que le programme termine en un instant \n i.e mettre visualization=False dans l'appel de optimal_translation")
-        fig.canvas.draw() ; renderer = fig.canvas.renderer
-    
-    # on fait varier notre première approximation pour trouver la translation la plus exacte possible :
-    # l'intervalle des perturbations est un paramètre modifiable, on a pris un peu large ici : sur les photos exemples 
-    # la première approximation de translation est à environ 4 - 5 pixels d'écart (écart horizontal + vertical)
-    for i in range(-10, 10):
-        for j in range(-10, 10):
-            new_top, new_left = top+i, left+j
-            if new_left+width >= im.shape[1] or new_left < 0 or new_top+height >= im.shape[0] or new_top < 0: 
-                continue 
-            
-            # nouvelle sous-image à comparer avec la sous-image de référence
-            rect = im[new_top:new_top+height, new_left:new_left+width]
-            
-            # identification des pixels qui seront utilisés pour la compraison dans la nouvelle sous-image :
-            # la comparaison sera effectuée que sur ces pixels filtrés (sensibilité des filtres est un paramètre),
-            # ici on ne retient que les pixels noirs purs et blancs purs.
-            black_pixels_mask = (rect == 0).astype(np.int8)
-            white_pixels_mask = (rect == 0xffff).astype(np.int8) 
-
-            # matrice "comparable"
-            to_compare = black_pixels_mask - white_pixels_mask
-
-            # calcul de la distance entre les deux matrices (choix de la norme 1 pour comparer des matrices de 1, 0 et -1)
-            diff = abs(to_compare_ref_rect - to_compare)            
-            dist = diff.sum()
-
-            if dist < min_dist:
-                min_dist = dist
-                best_top = new_top
-                best_left = new_left
-
-                if visualization:
-                    ax[0,2].cla() ; ax[0,2].set_title(f"Meilleur perturbation jusqu'à présent : {i},{j}") ; ax[0,2].imshow(diff) ; ax[0,2].draw(renderer) ; plt.pause(0.05)
-    
-            if visualization:
-                ax[1,2].cla() ; ax[1,2].set_title(f"{i},{j}") ; ax[1,2].imshow(diff) ; ax[1,2].draw(renderer) ; plt.pause(0.05)
+        rect = im[best_top:best_top+height, best_left:best_left+width]
+        diff = abs(template.A - comparable(rect))
+        ax[0,2].cla() ; ax[0,2].set_title(f"Meilleure perturbation : {best_top - top},{best_left - left}") ; ax[0,2].imshow(diff)
+        ax[1,2].cla() ; ax[1,2].set_title(f"distance pour chaque perturbation (rayon {radius})") ; ax[1,2].imshow(dist)
 
     return best_top, best_left
             
@@ -118,12 +179,10 @@ if __name__ == "__main__":
     ref_mi, ref_Mi, ref_mj, ref_Mj = locate_cross(ref_im, visualization=ax[0,0])
     ref_top, ref_left, height, width, di, dj, ref_rect = get_ref_rect(ref_im, ref_mi, ref_Mi, ref_mj, ref_Mj)
 
-    # identification des pixels du motif dans la sous-image de référence
-    black_pixels_mask = (ref_rect == 0).astype(np.int8)
-    white_pixels_mask = (ref_rect == 0xffff).astype(np.int8) 
-
-    # matrice utile pour la comparaison avec les sous-images des images à translater (matrice "comparable")
-    to_compare_ref_rect = black_pixels_mask - white_pixels_mask
+    # identification des pixels du motif dans la sous-image de référence :
+    # matrice utile pour la comparaison avec les sous-images des images à translater (matrice "comparable"),
+    # préparée une fois pour toutes les images à translater
+    to_compare_ref_rect = CrossTemplate(comparable(ref_rect))
 
     # image à translater
     im_name = "SE2.tif"
@@ -0,0 +1,237 @@
+# Application des translations : écriture de la pile d'images recalées.
+#
+# À partir d'une série d'images et de leurs translations (T_x, T_y) par rapport à la référence (celles de
+# find_translation, de batch_registration.py ou de global_alignment.py), on écrit la pile des images alignées,
+# recadrées sur la zone commune à toutes, dans un tableau numpy mappé en mémoire (.npy) ou un TIFF multi-pages.
+#
+# Les images sont traitées une par une : la mémoire utilisée est celle d'une image, quelle que soit la longueur
+# de la pile. Une translation entière n'est qu'un changement d'origine : l'image alignée est une vue (slicing)
+# de l'image lue, sans copie ni rééchantillonnage. Seules les translations sous-pixel (method="phase" avec
+# upsample_factor) passent par une interpolation bilinéaire (cv.warpAffine), limitée à la zone commune.
+#
+# Exemple : python batch_registration.py SE3.tif "acquisition/*.tif" -o translations.csv
+#           python aligned_stack.py translations.csv --ref SE3.tif -o aligned.tif
+
+import argparse
+import csv
+import itertools
+import math
+import struct
+import sys
+
+import numpy as np
+import cv2 as cv
+
+import phase_correlation
+
+
+def common_crop(shape, translations):
+    """
+    Zone commune à toutes les images alignées, en coordonnées de la référence : (top, bottom, left, right).
+
+    shape : (hauteur, largeur) des images
+    translations : array N x 2 des (T_x, T_y), avec ref[x,y] = im[x-T_x, y-T_y] ; l'image alignée contient
+    donc les pixels x de la référence tels que 0 <= x - T_x <= largeur - 1
+    """
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 2)
+    height, width = shape[:2]
+    left = math.ceil(max(translations[:,0].max(), 0))
+    top = math.ceil(max(translations[:,1].max(), 0))
+    right = math.floor(min(translations[:,0].min(), 0) + width - 1) + 1
+    bottom = math.floor(min(translations[:,1].min(), 0) + height - 1) + 1
+    if right <= left or bottom <= top:
+        raise ValueError("les images alignées n'ont aucune zone commune")
+    return top, bottom, left, right
+
+
+def align_frame(im, translation, crop):
+    """
+    Image im alignée sur la référence, restreinte à crop = (top, bottom, left, right) (voir common_crop).
+    Pour une translation entière, c'est une vue de im (aucune copie) ; sinon, une interpolation bilinéaire.
+    """
+    top, bottom, left, right = crop
+    T_x, T_y = float(translation[0]), float(translation[1])
+    if T_x.is_integer() and T_y.is_integer():
+        T_x, T_y = int(T_x), int(T_y)
+        return im[top - T_y:bottom - T_y, left - T_x:right - T_x]
+    # aligned[y, x] = im[y + top - T_y, x + left - T_x]
+    M = np.float64([[1, 0, left - T_x], [0, 1, top - T_y]])
+    return cv.warpAffine(im, M, (right - left, bottom - top), flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP)
+
+
+def aligned_frames(images, translations, filenames=True, crop=None):
+    """
+    Générateur des images alignées et recadrées sur la zone commune (ou sur crop), une par une.
+
+    images : itérable des images (noms de fichier si filenames est vrai, numpy arrays 2D sinon), toutes de même taille
+    translations : (T_x, T_y) de chaque image, dans le même ordre
+
+    Renvoie (crop, générateur) : crop est calculé avant de lire les images (sauf la première, pour sa taille).
+    Lève ValueError si images est vide.
+    """
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 2)
+    images = iter(images)
+    first = next(images, None)
+    if first is None:
+        raise ValueError("aucune image à écrire")
+    first_image = phase_correlation.read_image(first) if filenames else first
+    if crop is None:
+        crop = common_crop(first_image.shape, translations)
+
+    def frames():
+        for k, image in enumerate(itertools.chain([first_image], images)):
+            if filenames and k > 0:
+                image = phase_correlation.read_image(image)
+            if image.shape != first_image.shape:
+                raise ValueError(f"image {k} de taille {image.shape}, différente de la première {first_image.shape}")
+            yield align_frame(image, translations[k], crop)
+
+    return crop, frames()
+
+
+class TiffStackWriter:
+
+    """
+    Écriture d'un TIFF multi-pages (niveaux de gris, non compressé), une page à la fois.
+
+    Chaque page est écrite dès qu'elle est donnée (données puis répertoire de la page, chaîné au précédent) :
+    rien n'est gardé en mémoire. Format TIFF classique, limité à 4 Go.
+
+    with TiffStackWriter("aligned.tif") as writer:
+        for frame in frames:
+            writer.write(frame)
+    """
+
+    # type TIFF des valeurs : SHORT, LONG
+    _SHORT, _LONG = 3, 4
+    # SampleFormat selon le type numpy : entier non signé, entier signé, flottant
+    _SAMPLE_FORMATS = {"u": 1, "i": 2, "f": 3}
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        # en-tête : little-endian, 42, position du premier répertoire (écrite plus tard)
+        self.file.write(b"II" + struct.pack("<HI", 42, 0))
+        # position où écrire l'adresse du prochain répertoire
+        self._next_ifd_pointer = 4
+        self.n_pages = 0
+
+    def write(self, frame):
+        frame = np.asarray(frame)
+        if frame.ndim != 2 or frame.dtype.kind not in self._SAMPLE_FORMATS:
+            raise ValueError(f"image 2D de nombres attendue (forme {frame.shape}, type {frame.dtype})")
+        height, width = frame.shape
+        data = np.ascontiguousarray(frame, dtype=frame.dtype.newbyteorder("<"))
+
+        data_offset = self._align()
+        self.file.write(data.data)
+        if self.file.tell() >= 2**32:
+            raise ValueError("TIFF de plus de 4 Go : utiliser plutôt un fichier .npy")
+
+        entries = [
+            (256, self._LONG, width),                                   # ImageWidth
+            (257, self._LONG, height),                                  # ImageLength
+            (258, self._SHORT, 8 * frame.dtype.itemsize),               # BitsPerSample
+            (259, self._SHORT, 1),                                      # Compression : aucune
+            (262, self._SHORT, 1),                                      # PhotometricInterpretation : noir = 0
+            (273, self._LONG, data_offset),                             # StripOffsets (une seule bande)
+            (277, self._SHORT, 1),                                      # SamplesPerPixel
+            (278, self._LONG, height),                                  # RowsPerStrip
+            (279, self._LONG, data.nbytes),                             # StripByteCounts
+            (339, self._SHORT, self._SAMPLE_FORMATS[frame.dtype.kind]),  # SampleFormat
+        ]
+        ifd_offset = self._align()
+        ifd = struct.pack("<H", len(entries))
+        for tag, value_type, value in entries:
+            if value_type == self._SHORT:
+                ifd += struct.pack("<HHIHH", tag, value_type, 1, value, 0)
+            else:
+                ifd += struct.pack("<HHII", tag, value_type, 1, value)
+        self.file.write(ifd + struct.pack("<I", 0))
+
+        # chaînage : le répertoire précédent (ou l'en-tête) pointe vers celui-ci
+        end = self.file.tell()
+        self.file.seek(self._next_ifd_pointer)
+        self.file.write(struct.pack("<I", ifd_offset))
+        self.file.seek(end)
+        self._next_ifd_pointer = end - 4
+        self.n_pages += 1
+
+    def _align(self):
+        # les positions dans un TIFF doivent être paires
+        if self.file.tell() % 2:
+            self.file.write(b"\0")
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_stack(path, images, translations, filenames=True, crop=None):
+    """
+    Écrit dans path la pile des images alignées (voir aligned_frames), une image à la fois :
+    fichier .npy (forme N x hauteur x largeur, à ouvrir avec np.load(path, mmap_mode="r")) si path se termine
+    par .npy, TIFF multi-pages sinon.
+    Renvoie crop = (top, bottom, left, right), la zone de la référence couverte par la pile.
+    """
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 2)
+    crop, frames = aligned_frames(images, translations, filenames, crop)
+
+    if str(path).endswith(".npy"):
+        f = None
+        try:
+            for k, frame in enumerate(frames):
+                if f is None:
+                    # fichier .npy créé directement à sa taille finale (en-tête + données), puis rempli page par page
+                    # par de simples écritures : on ne garde jamais de vue sur toute la pile
+                    stack = np.lib.format.open_memmap(path, mode="w+", dtype=frame.dtype,
+                                                      shape=(len(translations),) + frame.shape)
+                    offset, frame_bytes = stack.offset, frame.nbytes
+                    del stack
+                    f = open(path, "r+b")
+                f.seek(offset + k * frame_bytes)
+                f.write(np.ascontiguousarray(frame).data)
+        finally:
+            if f is not None:
+                f.close()
+    else:
+        with TiffStackWriter(path) as writer:
+            for frame in frames:
+                writer.write(frame)
+    return crop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Écrit la pile des images recalées, recadrée sur leur zone commune")
+    parser.add_argument("translations", help="CSV des translations (colonnes image, T_x, T_y, et en option status "
+                                             "et index, l'ordre des images dans la pile), par exemple la sortie "
+                                             "de batch_registration.py")
+    parser.add_argument("-o", "--output", required=True, help="fichier de sortie : .tif (multi-pages) ou .npy")
+    parser.add_argument("--ref", help="image de référence, ajoutée en tête de la pile (translation nulle)")
+    args = parser.parse_args(argv)
+
+    with open(args.translations, newline="") as f:
+        rows = [row for row in csv.DictReader(f) if row.get("status", "ok") == "ok"]
+    # batch_registration.py écrit les résultats dans l'ordre où ils sont obtenus : on remet les images dans l'ordre
+    # donné en entrée grâce à la colonne index (sans cette colonne, l'ordre du fichier est gardé)
+    if rows and "index" in rows[0]:
+        rows.sort(key=lambda row: int(row["index"]))
+    images = [row["image"] for row in rows]
+    translations = [(float(row["T_x"]), float(row["T_y"])) for row in rows]
+    if args.ref:
+        images, translations = [args.ref] + images, [(0., 0.)] + translations
+    if not images:
+        print(f"erreur : aucune image recalée dans {args.translations}", file=sys.stderr)
+        return 2
+
+    top, bottom, left, right = write_stack(args.output, images, translations)
+    print(f"{len(images)} images écrites dans {args.output}, zone commune : x de {left} à {right}, y de {top} à {bottom}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+# Recalage d'un lot d'images sur une même référence, en parallèle, sans interaction.
+#
+# Exemple : python batch_registration.py SE3.tif "acquisition/*.tif" -o translations.csv --workers 32
+#
+# Chaque processus du pool construit une seule fois sa RegistrationSession (keypoints de la référence),
+# puis recale les images qu'on lui confie. Les résultats sont écrits au fur et à mesure qu'ils arrivent
+# (CSV, ou JSON à raison d'un objet par ligne), avec le temps de calcul et l'éventuelle erreur de chaque image.
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2 as cv
+
+import phase_correlation
+from registration import RegistrationSession, check_options
+
+
+# extensions des images prises dans un dossier
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+FIELDS = ["index", "image", "T_x", "T_y", "time", "status", "error"]
+
+# session propre à chaque processus du pool (construite par _init_worker)
+_session = None
+
+
+def _init_worker(ref, options):
+    global _session
+    # un seul thread OpenCV par processus : c'est le pool qui répartit le travail sur les coeurs
+    cv.setNumThreads(1)
+    _session = RegistrationSession(ref, **options)
+
+
+def _register(index, image):
+    start = time.perf_counter()
+    try:
+        T_x, T_y = _session.register(image)
+        result = dict(index=index, image=image, T_x=T_x.item(), T_y=T_y.item(), status="ok", error="")
+    except Exception as e:
+        result = dict(index=index, image=image, T_x=None, T_y=None, status="failed", error=f"{type(e).__name__}: {e}")
+    result["time"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def list_images(patterns, ref=None):
+    """
+    Liste des images désignées par patterns : noms de fichier, motifs glob ("acq/*.tif") ou dossiers
+    (on prend alors toutes les images TIFF du dossier : .tif ou .tiff, quelle que soit la casse). La référence elle-même est exclue de la liste.
+
+    L'ordre des patterns est gardé (c'est l'ordre d'acquisition pour global_alignment.py) : seules les images d'un
+    même motif ou dossier sont triées entre elles, par ordre naturel (frame_2 avant frame_10). Une image désignée
+    plusieurs fois n'est gardée qu'à sa première apparition.
+
+    Un nom de fichier sans caractère glob est gardé même s'il n'existe pas : son recalage échouera, et il apparaîtra
+    dans les résultats avec le statut "failed". Un motif glob qui ne désigne aucun fichier, ou un dossier sans image TIFF,
+    lève FileNotFoundError.
+    """
+    images, seen = [], set()
+    if ref is not None:
+        seen.add(os.path.abspath(ref))
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = [entry.path for entry in os.scandir(pattern)
+                     if entry.is_file() and entry.name.lower().endswith(TIFF_EXTENSIONS)]
+            if not found:
+                raise FileNotFoundError(f"aucune image TIFF dans le dossier {pattern!r}")
+        elif glob.has_magic(pattern):
+            found = glob.glob(pattern)
+            if not found:
+                raise FileNotFoundError(f"aucune image ne correspond au motif {pattern!r}")
+        else:
+            found = [pattern]
+        for image in sorted(found, key=_natural_key):
+            if os.path.abspath(image) not in seen:
+                seen.add(os.path.abspath(image))
+                images.append(image)
+    return images
+
+
+def _natural_key(filename):
+    # les nombres contenus dans le nom sont comparés comme des nombres : frame_2 < frame_10
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", filename)]
+
+
+def register_batch(ref, images, workers=None, options=None):
+    """
+    Recale les images (liste de noms de fichier) sur ref avec un pool de workers processus
+    (par défaut autant que de coeurs), et renvoie un générateur des résultats dans l'ordre où ils
+    sont obtenus. Chaque résultat est un dictionnaire de clés FIELDS, où index est la position de l'image dans images
+    (les résultats n'arrivent pas dans l'ordre des images).
+
+    options : paramètres transmis à RegistrationSession (method, matcher, radius, ...)
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(ref, options or {})) as pool:
+        futures = [pool.submit(_register, index, image) for index, image in enumerate(images)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recalage d'un lot d'images sur une image de référence")
+    parser.add_argument("ref", help="image de référence")
+    parser.add_argument("images", nargs="+", help="images à recaler : fichiers, motifs glob ou dossiers")
+    parser.add_argument("-o", "--output", help="fichier de sortie (.csv, ou .json/.jsonl pour un objet JSON par ligne), "
+                                               "sortie standard en CSV par défaut")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="nombre de processus (défaut : nombre de coeurs)")
+    parser.add_argument("--method", default="sift", choices=["sift", "phase", "pyramid", "keyzones", "cascade"])
+    # options propres à certaines méthodes : seules celles données sont transmises (les autres gardent les valeurs
+    # par défaut de RegistrationSession), et une option sans effet sur la méthode choisie est refusée
+    parser.add_argument("--matcher", choices=["bf", "flann"], help="appariement des keypoints SIFT (défaut : bf)")
+    parser.add_argument("--radius", type=float, help="rayon du clustering des translations (method=sift ou keyzones, défaut : 8)")
+    parser.add_argument("--auto-mask", action="store_true", help="exclut le bandeau d'acquisition de la détection SIFT")
+    parser.add_argument("--max-keypoints", type=int, help="nombre maximal de keypoints SIFT par image")
+    parser.add_argument("--pyramid-levels", type=int, help="nombre de niveaux de la pyramide (method=pyramid, défaut : 2)")
+    args = parser.parse_args(argv)
+
+    options = dict(matcher=args.matcher, radius=args.radius, pyramid_levels=args.pyramid_levels,
+                   mask="auto" if args.auto_mask else None, max_keypoints=args.max_keypoints)
+    options = {name: value for name, value in options.items() if value is not None}
+    try:
+        check_options(args.method, options)
+    except TypeError as e:
+        parser.error(str(e))
+    options["method"] = args.method
+
+    # une référence illisible ferait échouer l'initialisation de chaque processus du pool (BrokenProcessPool) :
+    # on la vérifie une fois, avant de créer le pool
+    try:
+        phase_correlation.read_image(args.ref)
+    except FileNotFoundError as e:
+        print(f"erreur : {e}", file=sys.stderr)
+        return 2
+
+    try:
+        images = list_images(args.images, args.ref)
+    except FileNotFoundError as e:
+        print(f"erreur : {e}", file=sys.stderr)
+        return 2
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    as_json = args.output is not None and args.output.endswith((".json", ".jsonl"))
+    if not as_json:
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        writer.writeheader()
+
+    failures = 0
+    start = time.perf_counter()
+    try:
+        for result in register_batch(args.ref, images, args.workers, options):
+            if as_json:
+                out.write(json.dumps(result) + "\n")
+            else:
+                writer.writerow(result)
+            out.flush()
+            failures += result["status"] != "ok"
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"{len(images)} images recalées en {time.perf_counter() - start:.1f} s, {failures} échec(s)", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
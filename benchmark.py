@@ -0,0 +1,233 @@
+# Banc d'essai des méthodes de recalage : vitesse et précision sur des translations connues.
+#
+# À partir des images fournies (SE*.tif, Nickel, 304L), on fabrique des paires (référence, image translatée)
+# dont on connaît exactement la translation : décalages entiers ou sous-pixel, bruit gaussien, et recadrage
+# (les deux images ne montrent qu'une partie commune de la scène). Chaque méthode est lancée sur chaque paire,
+# et on rapporte par méthode, type d'échantillon et taille d'image : les percentiles de latence, le pic de
+# mémoire (allocations numpy et Python, mesurées par tracemalloc) et l'erreur sur la translation.
+#
+# Exemple : python benchmark.py --cases 10 --scales 1 0.5 -o benchmark.json
+
+import argparse
+import contextlib
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import cv2 as cv
+
+import registration
+import Translate
+
+
+SAMPLES = {
+    "SE": ["SE1.tif", "SE2.tif", "SE3.tif", "SE4.tif", "SE5.tif"],
+    "Nickel": ["Nickel/Ref1.tif", "Nickel/ToBeAligned1.tif"],
+    "304L": ["304L/Ref.tif", "304L/ToBeAligned.tif"],
+}
+
+
+# Chaque méthode prend deux images 16 bits (numpy arrays) et renvoie la translation (T_x, T_y)
+# avec la convention de registration.find_translation : ref[x,y] = im[x-T_x, y-T_y].
+
+def _cross(ref, im):
+    # méthode du motif en croix de Translate.py (uniquement pertinente sur les images SE, qui contiennent la croix)
+    ref_top, ref_left, height, width, di, dj, ref_rect = Translate.get_ref_rect(ref, *Translate.locate_cross(ref))
+    mi, Mi, mj, Mj = Translate.locate_cross(im)
+    new_top, new_left = Translate.optimal_translation(Translate.comparable(ref_rect), height, width, mi - di, mj - dj, im)
+    return ref_left - new_left, ref_top - new_top
+
+
+def cross_window(im, translation, shape, slack=10):
+    """
+    Origine (top, left) d'une fenêtre de taille shape, dans im, telle que le motif en croix soit entier dans les deux
+    images de la paire construite par make_pair(..., origin=(top, left)), ou None s'il n'y en a pas.
+    Le motif, c'est le rectangle de Translate.get_ref_rect (boîte de la croix agrandie) et slack pixels autour
+    (rayon de recherche initial de Translate.optimal_translation).
+    """
+    top, left, height, width = Translate.get_ref_rect(im, *Translate.locate_cross(im))[:4]
+    origin = []
+    for first, last, size, full, T in ((top - slack, top + height - 1 + slack, shape[0], im.shape[0], translation[1]),
+                                       (left - slack, left + width - 1 + slack, shape[1], im.shape[1], translation[0])):
+        # la référence couvre [o, o+size[ et l'image translatée [o+T, o+T+size[, toutes deux dans l'image
+        # et contenant [first, last]
+        low = max(0, -T, last - size + 1, last - size + 1 - T)
+        high = min(full - size, full - size - T, first, first - T)
+        if low > high:
+            return None
+        origin.append(int(low + high) // 2)
+    return tuple(origin)
+
+
+METHODS = {
+    "sift": lambda ref, im: registration.find_translation(ref, im, filenames=False),
+    "sift-flann": lambda ref, im: registration.find_translation(ref, im, filenames=False, matcher="flann"),
+    "phase": lambda ref, im: registration.find_translation(ref, im, filenames=False, method="phase"),
+    "phase-subpixel": lambda ref, im: registration.find_translation(ref, im, filenames=False, method="phase", upsample_factor=20),
+    "pyramid": lambda ref, im: registration.find_translation(ref, im, filenames=False, method="pyramid"),
+    "keyzones": lambda ref, im: registration.find_translation(ref, im, filenames=False, method="keyzones"),
+    "cross": _cross,
+}
+
+# méthodes qui n'ont de sens que sur certains échantillons
+ONLY_ON = {"cross": ["SE"]}
+
+# méthodes qui repèrent un motif par des valeurs exactes de pixels (la croix : noir pur 0 et blanc pur 0xffff),
+# que le bruit, l'interpolation sous-pixel et la réduction d'échelle détruisent : elles ne sont lancées que sur les cas
+# entiers non bruités à l'échelle 1, sur des paires recadrées de façon à garder le motif entier dans les deux images
+# (fonction qui donne l'origine de la fenêtre, ou None si aucune ne convient pour cette image et cette translation)
+KEEP_PATTERN = {"cross": cross_window}
+
+
+def read_sample(filename, scale=1.):
+    im = cv.imread(filename, cv.IMREAD_ANYDEPTH)
+    if scale != 1:
+        im = cv.resize(im, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    return im
+
+
+def make_pair(im, translation, margin, noise=0., rng=None, origin=None):
+    """
+    Construit une paire (ref, moved) de même taille, découpées dans im avec une marge margin sur chaque bord,
+    telles que ref[x,y] = moved[x-T_x, y-T_y] pour translation = (T_x, T_y), éventuellement non entière
+    (interpolation bilinéaire). noise : écart-type du bruit gaussien ajouté à chaque image, en niveaux de gris.
+    origin : coin (top, left) de ref dans im, (margin, margin) par défaut (fenêtre centrée).
+    """
+    T_x, T_y = translation
+    h, w = im.shape[0] - 2 * margin, im.shape[1] - 2 * margin
+    top, left = origin or (margin, margin)
+    ref = im[top:top+h, left:left+w]
+    # moved[y', x'] = im[top + y' + T_y, left + x' + T_x]
+    M = np.float64([[1, 0, left + T_x], [0, 1, top + T_y]])
+    moved = cv.warpAffine(im, M, (w, h), flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP, borderMode=cv.BORDER_REFLECT)
+    if noise > 0:
+        rng = rng or np.random.default_rng()
+        top = np.iinfo(im.dtype).max
+        ref = np.clip(ref + rng.normal(0, noise, ref.shape), 0, top).astype(im.dtype)
+        moved = np.clip(moved + rng.normal(0, noise, moved.shape), 0, top).astype(im.dtype)
+    return np.ascontiguousarray(ref), moved
+
+
+def make_cases(n_cases, max_shift, seed=0):
+    """
+    Liste de n_cases cas (translation, bruit) : moitié de translations entières, moitié sous-pixel,
+    un cas sur trois bruité.
+    """
+    rng = np.random.default_rng(seed)
+    cases = []
+    for k in range(n_cases):
+        translation = rng.uniform(-max_shift, max_shift, 2)
+        if k % 2 == 0:
+            translation = np.round(translation)
+        noise = 1000. if k % 3 == 2 else 0.
+        cases.append((translation, noise))
+    return cases
+
+
+def run(methods, samples, scales, n_cases, max_shift=40, seed=0):
+    """
+    Lance le banc d'essai et renvoie la liste des résultats, un dictionnaire par (méthode, échantillon, taille).
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for sample in samples:
+        for scale in scales:
+            images = [read_sample(filename, scale) for filename in SAMPLES[sample]]
+            margin = int(np.ceil(max_shift * scale)) + 1
+            cases = make_cases(n_cases, max_shift * scale, seed)
+            pairs = []
+            for k, (translation, noise) in enumerate(cases):
+                pairs.append((translation, make_pair(images[k % len(images)], translation, margin, noise, rng)))
+
+            for method in methods:
+                if sample not in ONLY_ON.get(method, [sample]):
+                    continue
+                function = METHODS[method]
+                method_pairs = pairs
+                if method in KEEP_PATTERN:
+                    method_pairs = pattern_pairs(KEEP_PATTERN[method], images, cases, margin, scale)
+                    if not method_pairs:
+                        continue
+                latencies, errors, failures = [], [], 0
+                for translation, (ref, moved) in method_pairs:
+                    start = time.perf_counter()
+                    try:
+                        estimate = function(ref, moved)
+                    except Exception:
+                        failures += 1
+                        continue
+                    latencies.append(time.perf_counter() - start)
+                    errors.append(float(np.hypot(*(np.asarray(estimate, dtype=np.float64) - translation))))
+
+                # pic de mémoire mesuré à part : tracemalloc ralentit les allocations
+                translation, (ref, moved) = method_pairs[0]
+                tracemalloc.start()
+                with contextlib.suppress(Exception):
+                    function(ref, moved)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                results.append(dict(
+                    method=method, sample=sample, size=f"{ref.shape[1]}x{ref.shape[0]}",
+                    cases=len(method_pairs), failures=failures,
+                    p50_ms=_percentile_ms(latencies, 50), p90_ms=_percentile_ms(latencies, 90), p99_ms=_percentile_ms(latencies, 99),
+                    peak_mb=round(peak / 2**20, 2),
+                    mean_error=round(float(np.mean(errors)), 3) if errors else None,
+                    max_error=round(float(np.max(errors)), 3) if errors else None,
+                ))
+    return results
+
+
+def pattern_pairs(window, images, cases, margin, scale):
+    """
+    Paires pour une méthode de KEEP_PATTERN : les cas entiers non bruités (à l'échelle 1 seulement), chacun sur la
+    première image, à partir de celle du cas, où window trouve une fenêtre qui garde le motif entier.
+    """
+    pairs = []
+    if scale != 1:
+        return pairs
+    for k, (translation, noise) in enumerate(cases):
+        if noise > 0 or np.any(translation != np.round(translation)):
+            continue
+        shape = (images[0].shape[0] - 2 * margin, images[0].shape[1] - 2 * margin)
+        for im in images[k % len(images):] + images[:k % len(images)]:
+            origin = window(im, translation.astype(int), shape)
+            if origin is not None:
+                pairs.append((translation, make_pair(im, translation, margin, origin=origin)))
+                break
+    return pairs
+
+
+def _percentile_ms(latencies, q):
+    return round(1000 * float(np.percentile(latencies, q)), 1) if latencies else None
+
+
+def print_table(results):
+    columns = ["method", "sample", "size", "cases", "failures", "p50_ms", "p90_ms", "p99_ms", "peak_mb", "mean_error", "max_error"]
+    rows = [columns] + [[str(result[c]) for c in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banc d'essai des méthodes de recalage sur des translations connues")
+    parser.add_argument("--methods", nargs="+", default=list(METHODS), choices=list(METHODS))
+    parser.add_argument("--samples", nargs="+", default=list(SAMPLES), choices=list(SAMPLES))
+    parser.add_argument("--scales", nargs="+", type=float, default=[1.], help="facteurs d'échelle des images (tailles testées)")
+    parser.add_argument("--cases", type=int, default=6, help="nombre de paires par échantillon et par taille")
+    parser.add_argument("--max-shift", type=float, default=40, help="translation maximale (en pixels, à l'échelle 1)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="écrit aussi les résultats dans ce fichier JSON")
+    args = parser.parse_args(argv)
+
+    results = run(args.methods, args.samples, args.scales, args.cases, args.max_shift, args.seed)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
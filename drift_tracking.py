@@ -0,0 +1,269 @@
+# Suivi de la dérive de la platine en direct, image par image.
+#
+# Pendant une acquisition, les images arrivent les unes après les autres (dossier surveillé, ou générateur
+# fourni par le logiciel d'acquisition). Pour chacune, on calcule la translation par rapport à la référence
+# (ou à l'image précédente), et on renvoie la correction au fur et à mesure.
+#
+# La dérive varie lentement : on prédit la translation de l'image suivante à partir des précédentes
+# (vitesse constante, lissée), et on ne cherche qu'autour de cette prédiction, par corrélation de phase sur
+# une fenêtre du recouvrement prédit (registration.refine_translation), ce qui coûte toujours le même temps.
+# Si la prédiction est mauvaise (pic de corrélation trop faible, ou translation au bord de la zone de recherche),
+# on revient au recalage complet de registration.py (RegistrationSession, SIFT par défaut).
+#
+# Les images sont lues par un thread à part, dans une file de taille bornée : si un recalage est lent,
+# l'acquisition n'est pas bloquée tant que la file n'est pas pleine ; ensuite, soit le producteur attend
+# (backpressure), soit on abandonne les images les plus anciennes pour rester à jour (drop=True).
+#
+# Exemple : python drift_tracking.py SE3.tif acquisition/ --idle-timeout 60
+
+import argparse
+import csv
+import fnmatch
+import os
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+import phase_correlation
+from registration import RegistrationSession, refine_translation
+
+
+FIELDS = ["frame", "T_x", "T_y", "confidence", "stage", "latency", "dropped", "status", "error"]
+
+# fin du flux d'images, dans la file
+_END = object()
+
+
+class DriftTracker:
+
+    """
+    Suivi de la translation de chaque nouvelle image par rapport à une référence.
+
+    ref : numpy array ou string ; image de référence
+
+    filenames : bool ; indique si ref et les images suivies sont des noms de fichier (voir RegistrationSession)
+
+    against : "reference" ou "previous" ;
+    "reference" : chaque image est recalée sur la référence (par défaut),
+    "previous" : chaque image est recalée sur la précédente, et la dérive est la somme des translations successives ;
+    utile quand la scène change trop au cours de l'acquisition pour être comparée à la référence, mais les erreurs s'accumulent
+
+    search_radius : int ; écart maximal (en pixels) cherché autour de la translation prédite
+
+    min_confidence : float ; hauteur minimale du pic de corrélation pour accepter la translation trouvée autour
+    de la prédiction, sinon on fait un recalage complet
+
+    smoothing : float entre 0 et 1 ; poids de la dernière mesure dans l'estimation de la vitesse de dérive
+
+    options : paramètres du recalage complet, transmis à RegistrationSession (method, matcher, radius, ...)
+    """
+
+    def __init__(self, ref, filenames=True, against="reference", search_radius=8, min_confidence=0.1, smoothing=0.5,
+                 **options):
+        if against not in ("reference", "previous"):
+            raise ValueError(f"against inconnu : {against!r} (choisir 'reference' ou 'previous')")
+        self.filenames = filenames
+        self.against = against
+        self.search_radius = search_radius
+        self.min_confidence = min_confidence
+        self.smoothing = smoothing
+        self.options = options
+
+        self.ref = ref
+        self.ref_image = phase_correlation.read_image(ref) if filenames else ref
+        # session du recalage complet, sur l'image déjà lue ; avec against="previous", elle suit l'image de base
+        # (voir update), None quand elle est à recréer
+        self.session = RegistrationSession(self.ref_image, filenames=False, **options)
+
+        # dernière image vue (pour against="previous"), dérive courante (T_x, T_y) et vitesse par image
+        self.previous_image = self.ref_image
+        self.drift = None
+        self.velocity = np.zeros(2)
+
+    def predict(self, steps=1):
+        """
+        Translation prédite, par rapport à la référence, pour l'image qui arrive steps images après la dernière
+        (None avant la première image).
+        """
+        if self.drift is None:
+            return None
+        return self.drift + steps * self.velocity
+
+    def update(self, frame, steps=1):
+        """
+        Recale l'image frame (nom de fichier ou numpy array) et met à jour l'estimation de la dérive.
+        steps : nombre d'images écoulées depuis la précédente (plus de 1 si des images ont été abandonnées).
+        Renvoie le triplet (translation (T_x, T_y) par rapport à la référence, confiance, étape) où étape vaut
+        "tracked" si la translation a été trouvée autour de la prédiction, "full" s'il a fallu un recalage complet.
+        """
+        im = phase_correlation.read_image(frame) if self.filenames else frame
+
+        # la translation cherchée est relative à l'image de base : la référence, ou l'image précédente
+        predicted = self.predict(steps)
+        if predicted is not None and self.against == "previous":
+            predicted = steps * self.velocity
+        base_image = self.ref_image if self.against == "reference" else self.previous_image
+
+        translation, confidence, stage = None, None, "full"
+        if predicted is not None:
+            guess = np.round(predicted).astype(np.int32)
+            translation, confidence = refine_translation(base_image, im, guess, self.search_radius)
+            # un pic au bord de la zone de recherche signifie que la vraie translation est sans doute au-delà
+            on_border = np.abs(translation - guess).max() >= self.search_radius
+            if confidence >= self.min_confidence and not on_border:
+                stage = "tracked"
+
+        if stage == "full":
+            if self.session is None:
+                self.session = RegistrationSession(base_image, filenames=False, **self.options)
+            translation = self.session.register(im)
+            confidence = self.session.confidence
+
+        translation = np.asarray(translation, dtype=np.float64)
+        if self.against == "previous":
+            translation = translation + (self.drift if self.drift is not None else 0.)
+        if self.drift is not None:
+            self.velocity = (1 - self.smoothing) * self.velocity + self.smoothing * (translation - self.drift) / steps
+        self.drift = translation
+        self.previous_image = im
+        if self.against == "previous":
+            # im devient l'image de base : si elle vient d'être recalée par la session, ce qui a été calculé sur elle
+            # (keypoints, spectre, ...) sert de référence pour la suivante, sinon la session sera recréée au besoin
+            if stage == "full":
+                self.session.rebase()
+            else:
+                self.session = None
+        return translation, confidence, stage
+
+    def track(self, frames, queue_size=4, drop=False):
+        """
+        Générateur des corrections pour chaque image de frames (itérable, éventuellement infini, voir watch_directory),
+        dans l'ordre d'arrivée. Chaque correction est un dictionnaire de clés FIELDS.
+
+        Les images sont tirées de frames par un thread à part et placées dans une file de queue_size images :
+        l'acquisition peut prendre de l'avance sur le recalage. Quand la file est pleine, le thread attend
+        (drop=False), ou bien on abandonne l'image la plus ancienne de la file (drop=True) ; le nombre d'images
+        abandonnées depuis la correction précédente est donné dans le champ "dropped".
+        """
+        frames_queue = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        dropped = [0]
+        lock = threading.Lock()
+
+        def produce():
+            try:
+                for frame in frames:
+                    while not stop.is_set():
+                        try:
+                            frames_queue.put(frame, block=not drop, timeout=0.1)
+                            break
+                        except queue.Full:
+                            if drop:
+                                # on fait de la place en retirant l'image la plus ancienne
+                                try:
+                                    frames_queue.get_nowait()
+                                    with lock:
+                                        dropped[0] += 1
+                                except queue.Empty:
+                                    pass
+                    if stop.is_set():
+                        return
+                item = _END
+            except Exception as e:
+                # une erreur de la source d'images est transmise au consommateur
+                item = e
+            while not stop.is_set():
+                try:
+                    frames_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                frame = frames_queue.get()
+                if frame is _END:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+
+                start = time.perf_counter()
+                with lock:
+                    n_dropped, dropped[0] = dropped[0], 0
+                try:
+                    (T_x, T_y), confidence, stage = self.update(frame, n_dropped + 1)
+                    result = dict(frame=frame if self.filenames else None, T_x=float(T_x), T_y=float(T_y),
+                                  confidence=None if confidence is None else round(float(confidence), 4),
+                                  stage=stage, status="ok", error="")
+                except Exception as e:
+                    result = dict(frame=frame if self.filenames else None, T_x=None, T_y=None, confidence=None,
+                                  stage="failed", status="failed", error=f"{type(e).__name__}: {e}")
+                result["latency"] = round(time.perf_counter() - start, 4)
+                result["dropped"] = n_dropped
+                yield result
+        finally:
+            stop.set()
+
+
+def watch_directory(directory, pattern="*.tif", poll_interval=0.5, idle_timeout=None, existing=False):
+    """
+    Générateur des noms des nouveaux fichiers de directory correspondant à pattern, dans leur ordre d'apparition.
+
+    Un fichier n'est rendu que lorsque sa taille n'a pas changé entre deux examens du dossier (espacés de
+    poll_interval secondes), pour ne pas lire une image en cours d'écriture.
+
+    idle_timeout : float ou None ; arrête la surveillance si aucun nouveau fichier n'est apparu depuis idle_timeout secondes
+
+    existing : bool ; rend aussi les fichiers déjà présents au démarrage (sinon ils sont ignorés)
+    """
+    seen = set() if existing else {entry.path for entry in os.scandir(directory)}
+    sizes = {}
+    last_new = time.monotonic()
+    while idle_timeout is None or time.monotonic() - last_new < idle_timeout:
+        ready = []
+        for entry in os.scandir(directory):
+            if entry.path in seen or not entry.is_file() or not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            stat = entry.stat()
+            if sizes.get(entry.path) == stat.st_size:
+                ready.append((stat.st_mtime, entry.path))
+            sizes[entry.path] = stat.st_size
+        for _, path in sorted(ready):
+            seen.add(path)
+            del sizes[path]
+            last_new = time.monotonic()
+            yield path
+        time.sleep(poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Suivi en direct de la dérive de la platine")
+    parser.add_argument("ref", help="image de référence")
+    parser.add_argument("directory", help="dossier où arrivent les nouvelles images")
+    parser.add_argument("--pattern", default="*.tif")
+    parser.add_argument("--existing", action="store_true", help="traite aussi les images déjà présentes dans le dossier")
+    parser.add_argument("--idle-timeout", type=float, help="s'arrête après ce nombre de secondes sans nouvelle image")
+    parser.add_argument("--against", default="reference", choices=["reference", "previous"])
+    parser.add_argument("--search-radius", type=int, default=8)
+    parser.add_argument("--method", default="sift", choices=["sift", "phase", "pyramid", "keyzones", "cascade"],
+                        help="méthode du recalage complet")
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--drop", action="store_true", help="abandonne les images les plus anciennes quand la file est pleine")
+    args = parser.parse_args(argv)
+
+    tracker = DriftTracker(args.ref, against=args.against, search_radius=args.search_radius, method=args.method)
+    frames = watch_directory(args.directory, args.pattern, idle_timeout=args.idle_timeout, existing=args.existing)
+    writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+    writer.writeheader()
+    for result in tracker.track(frames, args.queue_size, args.drop):
+        writer.writerow(result)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# Cache sur disque des keypoints et descripteurs SIFT.
+#
+# Quand on retraite une campagne déjà recalée (avec une autre référence par exemple), les mêmes images
+# repassent par GaussianBlur et SIFT detectAndCompute. Le cache garde, pour chaque image, les coordonnées
+# des keypoints et les descripteurs dans un fichier .npz. La clé combine un hash du contenu de l'image et
+# les paramètres du flou et de SIFT : changer l'un d'eux donne une autre clé, donc on ne relit jamais des
+# points calculés avec d'autres réglages. La taille totale du cache est bornée : au-delà, on supprime les
+# entrées utilisées le moins récemment (LRU, d'après la date de dernière utilisation des fichiers).
+
+
+class FeatureCache:
+
+    """
+    directory : string ; dossier du cache (créé si besoin)
+
+    max_bytes : int ; taille maximale du cache sur le disque, en octets (500 Mo par défaut)
+    """
+
+    def __init__(self, directory, max_bytes=500 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(im, params):
+        """
+        Clé de l'image im (numpy array) pour les paramètres params (dictionnaire des paramètres du flou et de SIFT).
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(repr((im.shape, im.dtype.str, sorted(params.items()))).encode())
+        h.update(np.ascontiguousarray(im).data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """
+        Renvoie le couple (coordonnées des keypoints, descripteurs) enregistré sous key, ou None s'il n'y en a pas.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                points, descriptors = data["points"], data["descriptors"]
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        # on met à jour la date d'utilisation, qui sert à l'éviction LRU ; si un autre utilisateur du cache vient
+        # de supprimer l'entrée, les données sont déjà lues : c'est quand même un succès
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return points, descriptors
+
+    def save(self, key, points, descriptors):
+        # écriture dans un fichier temporaire puis renommage : un autre processus ne lit jamais un fichier à moitié écrit
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, points=points, descriptors=descriptors)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            # pas de fichier temporaire orphelin si l'écriture échoue (disque plein, interruption, ...)
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                # le cache peut être partagé (threads d'une session, processus d'un pool) : une entrée listée
+                # peut avoir été supprimée par un autre utilisateur entre-temps, on l'ignore
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
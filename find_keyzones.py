@@ -3,39 +3,41 @@ import cv2
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
+import registration
+import scale_space
+from preprocessing import Preprocessor
+from scale_space import ScaleSpace
+
 # Pour faire un recalage d'image, il faut d'abord trouver des points de repères sur les images.
 # On peut se servir de points "saillants", i.e. des points où le contraste est élevé sur l'image (contours, délimitations, irrégularités).
 # Une façon de trouver ces points est d'appliquer la méthode de différence de gradients.
 # Elle consiste en la soustraction de deux images obtenues en appliquant des flous gaussiens de deux intensités différentes à l'image à traiter.
 
 
-# On définit la fonction de différence de gaussiennes
-def DoG(im, radius_inf = 9., radius_sup = 10.):
-    im_inf = cv2.GaussianBlur(im, [0,0], radius_inf)
-    im_sup = cv2.GaussianBlur(im, [0,0], radius_sup)
+# On définit la fonction de différence de gaussiennes.
+# Elle est calculée par la pile de flous de scale_space.py, en float32 : dans le type de l'image (uint8, uint16),
+# la différence déborderait partout où elle est négative. La DoG reste dans les niveaux de gris de l'image.
+# Pour une série d'images de même taille, passer le même preprocessor (voir preprocessing.py) : ses buffers sont
+# réutilisés d'une image à l'autre (la DoG renvoyée est alors écrasée à l'appel suivant).
+def DoG(im, radius_inf = 9., radius_sup = 10., preprocessor = None):
     # On applique un autre flou gaussien au résultat pour limiter le bruit sur l'image
-    ret = cv2.GaussianBlur(im_inf - im_sup, [0,0], 3)
-    return ret
+    return ScaleSpace(im, preprocessor=preprocessor).DoG(radius_inf, radius_sup, 3)
 
-# On définit désormais la fonction mask qui renvoie un masque des points les plus saillants.
-def mask(im, tolerance_threshold = 10):
-    DoG_image = DoG(im)
-    max = np.max(DoG_image)
-    mask = (DoG_image > max - tolerance_threshold).astype(np.uint8)
-    return mask
+# On définit désormais la fonction mask qui renvoie un masque des points les plus saillants (voir scale_space.mask).
+def mask(im, tolerance_threshold = 10, preprocessor = None):
+    return scale_space.mask(DoG(im, preprocessor = preprocessor), tolerance_threshold)
 
 # On définit une fonction first_guess qui renvoie une première approximation du vecteur de translation à appliquer à partir de la position
 # moyenne des points saillants sur les deux images. Rq, cette méthode ne fonctionne pas très bien ...
 def first_guess(im_ref, im, tolerance_threshold = 10):
-    m_ref, m = mask(im_ref, tolerance_threshold), mask(im, tolerance_threshold)
+    preprocessor = Preprocessor()
+    m_ref, m = mask(im_ref, tolerance_threshold, preprocessor), mask(im, tolerance_threshold, preprocessor)
     x_ref, y_ref = np.where(m_ref == 1)
     x, y = np.where(m == 1)
     avg_x_ref = np.average(x_ref)
     avg_y_ref = np.average(y_ref)
     avg_x = np.average(x)
     avg_y = np.average(y)
-    print(x_ref, y_ref, x, y)
-    print(avg_x_ref, avg_y_ref, avg_x, avg_y)
     return (avg_x_ref - avg_x, avg_y_ref - avg_y)
 
 # Une fois que l'on a obtenu le masque avec les points saillants, on détecte les contours des motifs formés. 
@@ -51,13 +53,136 @@ def boundingbox(im):
     return ret
 
 
+# Recalage à partir des zones saillantes : plutôt que de moyenner tous les pixels du masque (first_guess),
+# on décrit chaque zone (composante connexe du masque) par son centre, son aire et sa bounding box,
+# puis on apparie les zones des deux images et on vote pour la translation.
+# On manipule quelques dizaines de zones au lieu des milliers de keypoints de SIFT.
+
+# Masque et zones sont calculés sur la DoG en flottants de scale_space.py (pas de débordement des entiers,
+# images 16 bits acceptées). Le seuil est relatif : on garde les points dont la DoG dépasse (1 - relative_tolerance) * max.
+# preprocessor : comme pour DoG (les zones renvoyées sont de nouveaux tableaux, elles ne sont pas écrasées).
+def keyzones(im, sigma_inf=3., sigma_sup=4., last_blur_sigma=3., relative_tolerance=0.7, preprocessor=None):
+    DoG_image = ScaleSpace(im, preprocessor=preprocessor).DoG(sigma_inf, sigma_sup, last_blur_sigma)
+    m = (DoG_image > (1 - relative_tolerance) * DoG_image.max()).astype(np.uint8)
+    return zone_stats(m)
+
+# Statistiques de toutes les composantes connexes d'un masque binaire, en un seul passage sur l'image :
+# renvoie les centres (x, y), les aires et les bounding boxes (x, y, w, h) des zones.
+def zone_stats(m):
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(m)
+    # la composante 0 est le fond
+    return centroids[1:], stats[1:, cv2.CC_STAT_AREA], stats[1:, :4]
+
+# Appariement des zones et vote. Chaque zone est décrite par sa forme : log de son aire, de la largeur et de la hauteur
+# de sa bounding box. Pour chaque zone de référence, on ne garde comme candidates que les max_candidates zones de im
+# les plus proches dans cet espace (plus proches voisins, cv2.BFMatcher), et parmi elles celles dont l'aire, la largeur
+# et la hauteur sont dans un rapport d'au moins area_ratio : au plus max_candidates paires par zone, au lieu de
+# toutes les paires d'aires compatibles. Chaque paire vote pour la translation centre_ref - centre (clustering de
+# registration.py, rayon radius).
+# Sur les images riches en zones, les zones d'une même région n'ont pas exactement la même forme d'une image à
+# l'autre et le vote est bruité : on examine les translations les plus soutenues, au nombre de peaks, et on garde celle qui
+# superpose le plus de zones (vérification : une zone de référence est retrouvée s'il y a un centre de zone de im
+# à moins de tolerance pixels de son centre translaté, quelle que soit sa forme). La translation renvoyée est la
+# médiane des écarts des zones retrouvées.
+# Renvoie (translation, nombre de zones retrouvées, nombre de paires candidates).
+def match_zones(ref_zones, zones, area_ratio=0.5, radius=8, max_candidates=24, peaks=8, tolerance=3):
+    ref_centroids, centroids = ref_zones[0], zones[0]
+    ref_shapes, shapes = zone_shapes(ref_zones), zone_shapes(zones)
+
+    k = min(max_candidates, len(shapes))
+    if len(ref_shapes) == 0 or k == 0:
+        raise ValueError("aucune paire de zones compatibles entre les deux images")
+    knn = cv2.BFMatcher(cv2.NORM_L2).knnMatch(ref_shapes, shapes, k=k)
+    pairs = np.array([(m.queryIdx, m.trainIdx) for matches in knn for m in matches], dtype=np.intp).reshape(-1, 2)
+    compatible = np.all(np.abs(ref_shapes[pairs[:,0]] - shapes[pairs[:,1]]) <= -np.log(area_ratio), axis=1)
+    pairs = pairs[compatible]
+    if len(pairs) == 0:
+        raise ValueError("aucune paire de zones compatibles entre les deux images")
+
+    translations = ref_centroids[pairs[:,0]] - centroids[pairs[:,1]]
+    best_support, best_translation = -1, None
+    for votes in vote_peaks(translations, radius, peaks):
+        translation, _ = registration.cluster_translations(votes, radius)
+        offsets = matched_offsets(ref_centroids, centroids, translation, tolerance)
+        if len(offsets) > best_support:
+            best_support, best_translation = len(offsets), translation
+            if len(offsets):
+                best_translation = np.round(np.median(offsets, axis=0)).astype(np.int32)
+    return best_translation, best_support, len(translations)
+
+# Votes des régions les plus soutenues de l'espace des translations (au nombre de peaks), en un seul passage : les votes sont comptés
+# dans une grille de cases de côté radius, chaque case reçoit la somme des votes de ses 9 cases voisines, et on
+# renvoie, pour chacune des meilleures cases (au nombre de peaks), la liste des votes de ses 9 cases voisines.
+def vote_peaks(translations, radius, peaks):
+    cells = np.floor(translations / radius).astype(np.int64)
+    cells -= cells.min(axis=0) - 1
+    n_cols = cells[:,1].max() + 2
+    cell_ids = cells[:,0] * n_cols + cells[:,1]
+    keys, counts = np.unique(cell_ids, return_counts=True)
+
+    offsets = np.array([di * n_cols + dj for di in (-1, 0, 1) for dj in (-1, 0, 1)])
+    neighbour_ids = keys.reshape(-1,1) + offsets
+    neighbour_cells = np.searchsorted(keys, neighbour_ids).clip(max=len(keys)-1)
+    present = keys[neighbour_cells] == neighbour_ids
+    scores = np.where(present, counts[neighbour_cells], 0).sum(axis=1)
+
+    for k in np.argsort(-scores, kind='stable')[:peaks]:
+        yield translations[np.isin(cell_ids, neighbour_ids[k])]
+
+# Descripteurs de forme des zones (voir match_zones) : log de l'aire, de la largeur et de la hauteur de la bounding box
+def zone_shapes(zones):
+    areas, bboxes = zones[1], zones[2]
+    return np.log(np.column_stack([areas, bboxes[:, 2], bboxes[:, 3]]).astype(np.float64)).astype(np.float32)
+
+# Écarts centre_ref - centre entre chaque zone de référence et la zone de im la plus proche de son centre translaté
+# (centre_ref - translation), pour celles qui en ont une à moins de tolerance pixels.
+# Les centres de im sont rangés dans une grille de cases de côté tolerance : on ne regarde que les 9 cases voisines.
+def matched_offsets(ref_centroids, centroids, translation, tolerance):
+    if len(ref_centroids) == 0 or len(centroids) == 0:
+        return np.zeros((0, 2))
+    targets = ref_centroids - translation
+    origin = np.minimum(centroids.min(axis=0), targets.min(axis=0)) - tolerance
+    cells = np.floor((centroids - origin) / tolerance).astype(np.int64)
+    n_cols = cells[:,1].max() + 3
+    cell_ids = cells[:,0] * n_cols + cells[:,1]
+    order = np.argsort(cell_ids, kind='stable')
+    sorted_ids = cell_ids[order]
+
+    target_cells = np.floor((targets - origin) / tolerance).astype(np.int64)
+    target_ids = target_cells[:,0] * n_cols + target_cells[:,1]
+    offsets = np.array([di * n_cols + dj for di in (-1, 0, 1) for dj in (-1, 0, 1)])
+    wanted = (target_ids.reshape(-1,1) + offsets).ravel()
+    lo = np.searchsorted(sorted_ids, wanted, side='left')
+    hi = np.searchsorted(sorted_ids, wanted, side='right')
+
+    # toutes les paires (zone de référence, zone de im dans l'une des 9 cases)
+    counts = hi - lo
+    i = np.repeat(np.repeat(np.arange(len(targets)), len(offsets)), counts)
+    j = order[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)]
+    dist_squared = ((targets[i] - centroids[j])**2).sum(axis=1)
+    close = dist_squared < tolerance**2
+    i, j, dist_squared = i[close], j[close], dist_squared[close]
+
+    # la plus proche zone de im pour chaque zone de référence
+    nearest = np.lexsort((dist_squared, i))
+    first = np.ones(len(nearest), dtype=bool)
+    first[1:] = i[nearest][1:] != i[nearest][:-1]
+    i, j = i[nearest][first], j[nearest][first]
+    return ref_centroids[i] - centroids[j]
+
+# Translation (T_x, T_y) entre im_ref et im (même convention que registration.find_translation)
+def keyzone_translation(im_ref, im, **params):
+    return match_zones(keyzones(im_ref, **params), keyzones(im, **params))[0]
+
+
 if __name__ == "__main__":
 
-    ref = cv2.cvtColor(cv2.imread("SE3.tif"), cv2.COLOR_BGR2GRAY)
-    to_translate = cv2.cvtColor(cv2.imread("SE2.tif"), cv2.COLOR_BGR2GRAY)
+    # images 16 bits : le seuil de tolérance est en niveaux de gris 16 bits
+    ref = cv2.imread("SE3.tif", cv2.IMREAD_ANYDEPTH)
+    to_translate = cv2.imread("SE2.tif", cv2.IMREAD_ANYDEPTH)
 
-    mask_ref = mask(ref, tolerance_threshold=30)
-    mask_trans = mask(to_translate, tolerance_threshold=30)
+    mask_ref = mask(ref, tolerance_threshold=900)
+    mask_trans = mask(to_translate, tolerance_threshold=900)
 
     bbox_ref = boundingbox(mask_ref)
     bbox_trans = boundingbox(mask_trans)
@@ -0,0 +1,323 @@
+# Alignement global d'un ensemble d'images.
+#
+# Recaler toutes les images d'une campagne sur une seule référence échoue dès qu'une image ne la recouvre plus
+# (dérive importante, mosaïque). Ici on recale des paires d'images voisines : voisines dans le temps (images
+# successives) et/ou d'après une position prédite (coordonnées de la platine par exemple), ce qui donne un graphe
+# creux de quelques arêtes par image au lieu des N² paires. Chaque arête donne une mesure de la translation entre
+# deux images ; on en déduit les positions de toutes les images par moindres carrés pondérés, en rejetant les
+# arêtes aberrantes (mauvais recalages) qui ne sont pas cohérentes avec les autres.
+#
+# Les arêtes sont calculées en parallèle (un pool de processus, comme batch_registration.py), regroupées par
+# image de référence pour ne calculer qu'une fois ses keypoints ; avec --cache, les keypoints de chaque image sont
+# aussi gardés sur le disque et réutilisés quand l'image sert à nouveau (voir feature_cache.py).
+#
+# Exemple : python global_alignment.py "acquisition/*.tif" --window 2 --cache cache_sift -o positions.csv
+
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import cv2 as cv
+try:
+    import scipy.sparse
+    import scipy.sparse.linalg
+except ImportError:
+    # sans scipy, les moindres carrés sont résolus par gradient conjugué (plus lent sur de longues chaînes d'images)
+    scipy = None
+
+import phase_correlation
+from batch_registration import list_images
+from registration import RegistrationSession, check_options
+
+
+def temporal_edges(n, window=2):
+    """
+    Arêtes (i, j) entre chaque image et les window images suivantes (array E x 2, i < j).
+    """
+    return np.array([(i, j) for i in range(n) for j in range(i + 1, min(n, i + window + 1))], dtype=np.intp).reshape(-1, 2)
+
+
+def position_edges(positions, shape, min_overlap=0.3, max_neighbours=8):
+    """
+    Arêtes (i, j) entre les images dont les positions prédites (array N x 2 de (x, y), en pixels) donnent un recouvrement
+    d'au moins min_overlap (fraction de la largeur et de la hauteur) ; au plus max_neighbours voisins, les plus proches,
+    par image. shape : (hauteur, largeur) des images.
+
+    Les images sont rangées dans une grille de cases de la taille du décalage maximal : les voisins d'une image
+    sont dans sa case ou les 8 cases adjacentes, on ne compare donc pas toutes les paires.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    max_shift = np.array([shape[1], shape[0]]) * (1 - min_overlap)
+    cells = np.floor(positions / max_shift).astype(np.int64)
+    grid = {}
+    for i, cell in enumerate(map(tuple, cells)):
+        grid.setdefault(cell, []).append(i)
+
+    edges = set()
+    for i, (cx, cy) in enumerate(cells):
+        candidates = np.array([j for dx in (-1, 0, 1) for dy in (-1, 0, 1) for j in grid.get((cx + dx, cy + dy), ()) if j != i],
+                              dtype=np.intp)
+        if len(candidates) == 0:
+            continue
+        offsets = np.abs(positions[candidates] - positions[i])
+        candidates = candidates[(offsets < max_shift).all(axis=1)]
+        distances = np.hypot(*(positions[candidates] - positions[i]).T)
+        for j in candidates[np.argsort(distances, kind='stable')[:max_neighbours]]:
+            edges.add((min(i, j), max(i, j)))
+    return np.array(sorted(edges), dtype=np.intp).reshape(-1, 2)
+
+
+# options de RegistrationSession propres à chaque processus du pool (fixées par _init_worker)
+_options = None
+
+
+def _init_worker(options):
+    global _options
+    # un seul thread OpenCV par processus : c'est le pool qui répartit le travail sur les coeurs
+    cv.setNumThreads(1)
+    _options = options
+
+
+def _register_group(i, ref, targets):
+    # une session par image de référence : ses keypoints servent à toutes ses arêtes
+    results = []
+    try:
+        session = RegistrationSession(ref, **_options)
+    except Exception as e:
+        return [(i, j, None, 0., f"{type(e).__name__}: {e}") for j, _ in targets]
+    for j, image in targets:
+        try:
+            translation, diagnostics = session.register(image, return_diagnostics=True)
+            # poids de la mesure : taille du cluster de translations (SIFT, zones) ou confiance (corrélation de phase)
+            weight = diagnostics.cluster_size if diagnostics.cluster_size is not None else diagnostics.confidence
+            weight = 1. if weight is None else float(weight)
+            if weight <= 0:
+                # (recouvrement trop petit pour l'affinage de method="pyramid", ...) : la mesure ne vaut rien
+                results.append((i, j, None, 0., f"confiance nulle (translation {np.asarray(translation).tolist()})"))
+                continue
+            results.append((i, j, np.asarray(translation, dtype=np.float64), weight, ""))
+        except Exception as e:
+            results.append((i, j, None, 0., f"{type(e).__name__}: {e}"))
+    return results
+
+
+def register_edges(images, edges, workers=None, options=None):
+    """
+    Recale les paires d'images (noms de fichier) données par edges (array E x 2 d'indices dans images) avec un pool
+    de workers processus. Renvoie (edges gardées, translations (E' x 2), poids (E'), erreurs) : translations[k] est
+    la translation (T_x, T_y) de images[j] par rapport à images[i] (convention de find_translation, i = référence),
+    les arêtes dont le recalage a échoué sont retirées et leurs erreurs listées dans le dictionnaire erreurs.
+
+    options : paramètres transmis à RegistrationSession (method, matcher, cache, ...)
+    """
+    groups = {}
+    for i, j in edges:
+        groups.setdefault(int(i), []).append((int(j), images[j]))
+
+    kept, translations, weights, errors = [], [], [], {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options or {},)) as pool:
+        futures = [pool.submit(_register_group, i, images[i], targets) for i, targets in groups.items()]
+        for future in as_completed(futures):
+            for i, j, translation, weight, error in future.result():
+                if translation is None:
+                    errors[(i, j)] = error
+                    continue
+                kept.append((i, j))
+                translations.append(translation)
+                weights.append(weight)
+
+    order = np.lexsort(np.array(kept).T[::-1]) if kept else np.zeros(0, dtype=np.intp)
+    return (np.array(kept, dtype=np.intp).reshape(-1, 2)[order], np.array(translations).reshape(-1, 2)[order],
+            np.array(weights)[order], errors)
+
+
+def solve_positions(n, edges, translations, weights=None, max_residual=3., n_sigmas=4., max_iterations=20):
+    """
+    Positions (T_x, T_y) des n images, cohérentes avec les mesures des arêtes : pour une arête (i, j) de translation T,
+    on veut position[j] - position[i] = T (voir register_edges) ; on minimise la somme pondérée des carrés des écarts.
+
+    Les positions sont relatives à la première image de chaque composante connexe du graphe (position 0 pour
+    l'image 0 si tout est connecté).
+
+    Rejet des arêtes aberrantes : on résout par moindres carrés itérativement repondérés ; une arête fausse, en
+    contradiction avec les autres chemins du graphe, perd ainsi son influence sans qu'on coupe le graphe.
+    On commence par une perte de Huber (poids multiplié par min(1, max_residual / écart)), convexe, qui ne dépend
+    pas de la solution de départ, puis on termine par une perte de Cauchy (poids divisé par 1 + (écart / max_residual)²),
+    qui annule presque complètement l'influence des arêtes aberrantes.
+    À la fin, une arête est déclarée aberrante si son écart dépasse max_residual pixels et n_sigmas fois l'écart
+    typique (estimé robustement par la médiane).
+
+    Renvoie (positions (n x 2), masque des arêtes cohérentes, numéro de composante connexe de chaque image).
+    """
+    edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 2)
+    weights = np.ones(len(edges)) if weights is None else np.asarray(weights, dtype=np.float64)
+    components = connected_components(n, edges)
+
+    positions = _weighted_least_squares(n, edges, translations, weights, components)
+    for loss in ("huber", "cauchy"):
+        for _ in range(max_iterations):
+            residuals = np.hypot(*(positions[edges[:,1]] - positions[edges[:,0]] - translations).T)
+            if loss == "huber":
+                robust_weights = weights * np.minimum(1., max_residual / np.maximum(residuals, 1e-12))
+            else:
+                robust_weights = weights / (1 + (residuals / max_residual)**2)
+            # on repart des positions précédentes (utile au gradient conjugué)
+            new_positions = _weighted_least_squares(n, edges, translations, robust_weights, components, positions)
+            converged = np.abs(new_positions - positions).max() < 0.01
+            positions = new_positions
+            if converged:
+                break
+
+    residuals = np.hypot(*(positions[edges[:,1]] - positions[edges[:,0]] - translations).T)
+
+    # écart typique robuste (1.4826 * médiane des écarts absolus, pour une loi normale)
+    sigma = 1.4826 * np.median(residuals) if len(residuals) else 0.
+    inliers = residuals <= max(max_residual, n_sigmas * sigma)
+    return positions, inliers, components
+
+
+def connected_components(n, edges):
+    """
+    Numéro de composante connexe de chacun des n sommets du graphe (union-find), numérotées dans l'ordre
+    de leur premier sommet.
+    """
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in edges:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    roots = np.array([find(i) for i in range(n)])
+    return np.unique(roots, return_inverse=True)[1].reshape(-1)
+
+
+def _weighted_least_squares(n, edges, translations, weights, components, start=None, tolerance=1e-6, max_iterations=None):
+    # Équations normales : L p = b, avec L le laplacien pondéré du graphe (creux : on ne stocke que les arêtes).
+    # On fixe la première image de chaque composante à 0 en ajoutant une arête vers l'origine, ce qui rend le
+    # système défini positif. Avec scipy, on le résout directement (factorisation creuse) ; sinon par gradient
+    # conjugué préconditionné par la diagonale : chaque itération coûte O(nombre d'arêtes), sans jamais former
+    # de matrice n x n.
+    i, j = edges[:,0], edges[:,1]
+    anchors = np.zeros(n)
+    anchors[np.unique(components, return_index=True)[1]] = max(weights.max(), 1.) if len(weights) else 1.
+    degree = np.bincount(i, weights, n) + np.bincount(j, weights, n) + anchors
+
+    def laplacian(p):
+        neighbours = np.zeros_like(p)
+        for axis in range(p.shape[1]):
+            neighbours[:,axis] = np.bincount(i, weights * p[j, axis], n) + np.bincount(j, weights * p[i, axis], n)
+        return degree.reshape(-1, 1) * p - neighbours
+
+    b = np.zeros((n, 2))
+    for axis in range(2):
+        b[:,axis] = np.bincount(j, weights * translations[:,axis], n) - np.bincount(i, weights * translations[:,axis], n)
+
+    if scipy is not None:
+        off_diagonal = scipy.sparse.coo_matrix((np.concatenate([-weights, -weights]),
+                                                (np.concatenate([i, j]), np.concatenate([j, i]))), shape=(n, n))
+        solve = scipy.sparse.linalg.factorized((off_diagonal + scipy.sparse.diags(degree)).tocsc())
+        return np.stack([solve(b[:,0]), solve(b[:,1])], axis=1)
+
+    # gradient conjugué, sur les deux coordonnées à la fois (le même système)
+    p = np.zeros((n, 2)) if start is None else start.copy()
+    r = b - laplacian(p)
+    z = r / degree.reshape(-1, 1)
+    d = z.copy()
+    rz = (r * z).sum(axis=0)
+    for _ in range(max_iterations or 10 * n):
+        if np.sqrt((r**2).sum()) <= tolerance * max(np.sqrt((b**2).sum()), 1.):
+            break
+        Ld = laplacian(d)
+        alpha = rz / np.maximum((d * Ld).sum(axis=0), 1e-300)
+        p += alpha * d
+        r -= alpha * Ld
+        z = r / degree.reshape(-1, 1)
+        new_rz = (r * z).sum(axis=0)
+        d = z + (new_rz / np.maximum(rz, 1e-300)) * d
+        rz = new_rz
+    return p
+
+
+def align(images, edges, workers=None, options=None, **solver_options):
+    """
+    Recale les paires edges des images (noms de fichier) puis calcule leurs positions globales.
+    Renvoie (positions, composantes, arêtes gardées, translations, poids, masque des arêtes cohérentes, erreurs),
+    voir register_edges et solve_positions.
+    """
+    kept, translations, weights, errors = register_edges(images, edges, workers, options)
+    positions, inliers, components = solve_positions(len(images), kept, translations, weights, **solver_options)
+    return positions, components, kept, translations, weights, inliers, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Alignement global d'un ensemble d'images par recalage de paires voisines")
+    parser.add_argument("images", nargs="+", help="images, dans l'ordre d'acquisition : fichiers, motifs glob "
+                                                    "ou dossiers (images d'un même motif triées par ordre naturel)")
+    parser.add_argument("-o", "--output", help="fichier CSV des positions (sortie standard par défaut)")
+    parser.add_argument("--window", type=int, default=2, help="nombre d'images suivantes recalées sur chaque image")
+    parser.add_argument("--positions", help="CSV (image, x, y) des positions prédites, en pixels : ajoute les paires "
+                                            "d'images qui se recouvrent d'après ces positions")
+    parser.add_argument("--min-overlap", type=float, default=0.3)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--method", default="sift", choices=["sift", "phase", "pyramid", "keyzones", "cascade"])
+    parser.add_argument("--cache", help="dossier du cache des keypoints SIFT (method=sift, ou cascade avec sift)")
+    parser.add_argument("--max-residual", type=float, default=3., help="écart (en pixels) en dessous duquel une arête est toujours gardée")
+    args = parser.parse_args(argv)
+
+    options = dict(cache=args.cache) if args.cache else {}
+    try:
+        check_options(args.method, options)
+    except TypeError as e:
+        parser.error(str(e))
+    options["method"] = args.method
+
+    try:
+        images = list_images(args.images)
+    except FileNotFoundError as e:
+        print(f"erreur : {e}", file=sys.stderr)
+        return 2
+    if not images:
+        print("erreur : aucune image trouvée", file=sys.stderr)
+        return 2
+    edges = temporal_edges(len(images), args.window)
+    if args.positions:
+        with open(args.positions, newline="") as f:
+            predicted = {os.path.abspath(row["image"]): (float(row["x"]), float(row["y"])) for row in csv.DictReader(f)}
+        positions = np.array([predicted[os.path.abspath(image)] for image in images])
+        try:
+            shape = phase_correlation.read_image(images[0]).shape
+        except FileNotFoundError as e:
+            print(f"erreur : {e}", file=sys.stderr)
+            return 2
+        edges = np.unique(np.concatenate([edges, position_edges(positions, shape, args.min_overlap)]), axis=0)
+
+    positions, components, kept, translations, weights, inliers, errors = align(
+        images, edges, args.workers, options, max_residual=args.max_residual)
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(["image", "T_x", "T_y", "component"])
+        for image, (T_x, T_y), component in zip(images, positions, components):
+            writer.writerow([image, round(T_x, 2), round(T_y, 2), component])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"{len(images)} images, {len(edges)} paires : {len(errors)} échec(s), {np.count_nonzero(~inliers)} rejetée(s), "
+          f"{components.max() + 1 if len(components) else 0} composante(s) connexe(s)", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import numpy as np
+import cv2 as cv
+
+# Corrélation de phase : une translation entre deux images se traduit, dans l'espace de Fourier,
+# par un déphasage. Si ref[x,y] = im[x-T_x, y-T_y], alors F(ref) = F(im) * exp(-2iπ(u T_x + v T_y)).
+# En ne gardant que la phase du spectre croisé F(ref) * conj(F(im)), puis en revenant dans l'espace
+# direct, on obtient un pic (idéalement un Dirac) à la position (T_x, T_y).
+# Pas d'extraction de points clé : tout le calcul tient en quelques FFT, en O(N log N).
+
+
+def read_image(filename):
+    """
+    Lit une image en niveaux de gris en gardant sa profondeur d'origine (16 bits pour nos images MEB),
+    contrairement à cv.IMREAD_GRAYSCALE qui ramène tout sur 8 bits.
+    """
+    im = cv.imread(filename, cv.IMREAD_ANYDEPTH)
+    if im is None:
+        raise FileNotFoundError(f"impossible de lire l'image {filename!r}")
+    return im
+
+
+def spectrum(im, window=True):
+    """
+    Transformée de Fourier de l'image im (numpy array 2D, de n'importe quel dtype),
+    après soustraction de la moyenne et, si window=True, multiplication par une fenêtre de Hann.
+
+    La fenêtre atténue les bords de l'image : sans elle, la discontinuité entre les bords opposés
+    (la FFT suppose l'image périodique) crée un pic parasite en translation nulle.
+    """
+    im = im.astype(np.float64)
+    im -= im.mean()
+    if window:
+        im *= np.outer(np.hanning(im.shape[0]), np.hanning(im.shape[1]))
+    return np.fft.fft2(im)
+
+
+def translation_from_spectra(ref_spectrum, spectrum, upsample_factor=1, max_shift=None, confidence="height"):
+    """
+    Calcule la translation (T_x, T_y) entre deux images à partir de leurs spectres (voir la fonction spectrum),
+    renvoie le couple (translation, confiance).
+
+    upsample_factor : int ; si > 1, la position du pic est affinée à 1/upsample_factor pixel près,
+    en calculant la transformée de Fourier inverse suréchantillonnée uniquement autour du pic
+    (méthode de Guizar-Sicairos et al., 2008), ce qui évite de zero-padder toute l'image.
+
+    max_shift : int ou None ; si donné, on ne cherche le pic que parmi les translations dont chaque
+    composante est inférieure à max_shift en valeur absolue (utile quand on connaît déjà une estimation)
+
+    confidence : "height" ou "ratio" ;
+    "height" : la confiance est la hauteur du pic de corrélation de phase, entre 0 et 1 : proche de 1 pour
+    une translation pure, proche de 0 lorsque les images n'ont rien en commun,
+    "ratio" : la confiance est le rapport entre la hauteur du pic et celle du plus haut pic secondaire
+    (hors d'un voisinage de PEAK_EXCLUSION pixels autour du pic) : proche de 1 quand le pic ne se distingue pas
+    du bruit, nettement plus grand sinon ; ce rapport dépend moins de la texture de l'image que la hauteur
+    """
+    if confidence not in ("height", "ratio"):
+        raise ValueError(f"confidence inconnue : {confidence!r} (choisir 'height' ou 'ratio')")
+    if ref_spectrum.shape != spectrum.shape:
+        raise ValueError(f"les deux images doivent avoir la même taille ({ref_spectrum.shape} != {spectrum.shape})")
+
+    # spectre croisé normalisé : on ne garde que la phase
+    cross_power = ref_spectrum * spectrum.conj()
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+
+    correlation = np.abs(np.fft.ifft2(cross_power))
+    shape = np.array(correlation.shape)
+
+    if max_shift is None:
+        peak = np.unravel_index(correlation.argmax(), correlation.shape)
+        height = correlation[peak]
+        surface, wrap = correlation, True
+
+        # le pic est à une position modulo la taille de l'image : au-delà de la moitié, c'est une translation négative
+        shifts = np.array(peak, dtype=np.float64)
+        shifts[shifts > shape // 2] -= shape[shifts > shape // 2]
+    else:
+        # on n'examine que la fenêtre [-max_shift, max_shift]² (les indices négatifs sont repliés)
+        max_shifts = np.minimum(int(max_shift), (shape - 1) // 2)
+        rows = np.arange(-max_shifts[0], max_shifts[0] + 1)
+        cols = np.arange(-max_shifts[1], max_shifts[1] + 1)
+        window = correlation[np.ix_(rows % shape[0], cols % shape[1])]
+        peak = np.unravel_index(window.argmax(), window.shape)
+        height = window[peak]
+        surface, wrap = window, False
+        shifts = np.array([rows[peak[0]], cols[peak[1]]], dtype=np.float64)
+
+    if upsample_factor > 1:
+        # on suréchantillonne une zone de 1.5 pixel autour du pic
+        upsample_factor = float(upsample_factor)
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        region_size = np.ceil(upsample_factor * 1.5)
+        dftshift = np.fix(region_size / 2.0)
+        offsets = dftshift - shifts * upsample_factor
+
+        upsampled = np.abs(_upsampled_dft(cross_power.conj(), int(region_size), upsample_factor, offsets))
+        upsampled_peak = np.array(np.unravel_index(upsampled.argmax(), upsampled.shape), dtype=np.float64)
+        shifts += (upsampled_peak - dftshift) / upsample_factor
+        translation = shifts[::-1]
+    else:
+        translation = shifts[::-1].astype(np.int32)
+
+    if confidence == "ratio":
+        height = height / max(_secondary_peak(surface, peak, wrap), 1e-12)
+
+    # shifts est en (ligne, colonne) = (y, x), on renvoie (T_x, T_y) comme find_translation
+    return translation, height
+
+
+# rayon (en pixels) du voisinage du pic ignoré dans la recherche du pic secondaire
+PEAK_EXCLUSION = 5
+
+
+def _secondary_peak(surface, peak, wrap):
+    """
+    Hauteur du plus haut point de surface hors du voisinage de peak (replié sur les bords si wrap est vrai).
+    """
+    rows = np.arange(peak[0] - PEAK_EXCLUSION, peak[0] + PEAK_EXCLUSION + 1)
+    cols = np.arange(peak[1] - PEAK_EXCLUSION, peak[1] + PEAK_EXCLUSION + 1)
+    if wrap:
+        rows, cols = rows % surface.shape[0], cols % surface.shape[1]
+    else:
+        rows = rows[(rows >= 0) & (rows < surface.shape[0])]
+        cols = cols[(cols >= 0) & (cols < surface.shape[1])]
+    masked = surface.copy()
+    masked[np.ix_(rows, cols)] = 0
+    return masked.max()
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    """
+    Transformée de Fourier inverse de data, suréchantillonnée d'un facteur upsample_factor,
+    calculée uniquement sur une fenêtre de region_size x region_size échantillons commençant à offsets.
+    Équivalent à zero-padder data puis faire une ifft2, mais par deux produits matriciels.
+    """
+    # on traite les colonnes puis les lignes : à chaque étape le dernier axe est contracté
+    # et l'axe suréchantillonné est placé en tête
+    for axis in (1, 0):
+        n = data.shape[-1]
+        samples = np.arange(region_size) - offsets[axis]
+        kernel = np.exp(-2j * np.pi * np.outer(samples, np.fft.fftfreq(n, upsample_factor)))
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+
+def phase_correlation(ref, toTranslate, window=True, upsample_factor=1, max_shift=None, confidence="height"):
+    """
+    Translation (T_x, T_y) telle que ref[x,y] = toTranslate[x-T_x, y-T_y], par corrélation de phase.
+
+    ref, toTranslate : numpy arrays 2D de même taille (8 ou 16 bits, ou flottants)
+
+    window : bool ; applique une fenêtre de Hann avant la FFT
+
+    upsample_factor : int ; précision sous-pixel (1 : translation entière)
+
+    max_shift : int ou None ; limite la recherche aux translations de composantes inférieures à max_shift
+
+    confidence : "height" ou "ratio", voir translation_from_spectra
+
+    Renvoie le couple (translation, confiance), voir translation_from_spectra.
+    """
+    return translation_from_spectra(spectrum(ref, window), spectrum(toTranslate, window), upsample_factor, max_shift,
+                                    confidence)
+
+
+if __name__ == "__main__":
+    ref = read_image("SE3.tif")
+    im = read_image("SE2.tif")
+    print(phase_correlation(ref, im))
+    print(phase_correlation(ref, im, upsample_factor=20))
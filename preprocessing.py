@@ -0,0 +1,76 @@
+# Prétraitement commun des images, à pleine profondeur, dans des buffers réutilisés.
+#
+# Nos images MEB sont en 16 bits : cv.IMREAD_GRAYSCALE les ramène sur 8 bits avant tout calcul, et une différence
+# de deux flous calculée dans le type de l'image (uint8 ou uint16) déborde (10 - 12 donne 65534 au lieu de -2).
+# Ici l'image est convertie une seule fois en float32, et les flous sont calculés en flottants. Les DoG sont
+# calculées par scale_space.ScaleSpace, qui prend un Preprocessor pour écrire dans ses buffers.
+#
+# Pour un lot d'images de même taille, les tableaux de sortie (conversion, flous, DoG) sont alloués une fois
+# par taille, puis réutilisés d'une image à l'autre (paramètre dst= d'OpenCV, opérations en place) : plus
+# d'allocation de plusieurs tableaux de la taille de l'image à chaque image.
+#
+# Un tableau renvoyé par un Preprocessor n'est valable que jusqu'à l'appel suivant sur une image de même taille
+# (il sera écrasé) : le copier s'il faut le garder. Un Preprocessor ne doit pas être partagé entre threads.
+
+import numpy as np
+import cv2 as cv
+
+
+def full_scale(dtype):
+    """
+    Valeur maximale d'une image de type dtype : 255 ou 65535 pour les entiers non signés, 1 pour les flottants.
+    """
+    dtype = np.dtype(dtype)
+    return float(np.iinfo(dtype).max) if dtype.kind in "ui" else 1.
+
+
+class Preprocessor:
+
+    """
+    Conversion en float32, flous gaussiens et quantification sur 8 bits dans des buffers réutilisés d'une image
+    à l'autre (ainsi que les DoG de scale_space.ScaleSpace, qui utilise buffer).
+
+    preprocessor = Preprocessor()
+    for im in images:
+        DoG_im = ScaleSpace(im, preprocessor=preprocessor).DoG(9., 10., 3.)   # écrasé à l'image suivante
+    """
+
+    def __init__(self):
+        # buffers, par (nom, forme, type)
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype=np.float32):
+        """
+        Tableau de travail nommé name, de forme shape : alloué au premier appel, le même ensuite.
+        """
+        key = (name, tuple(shape), np.dtype(dtype))
+        if key not in self._buffers:
+            self._buffers[key] = np.empty(shape, dtype=dtype)
+        return self._buffers[key]
+
+    def to_float32(self, im, normalize=False, name="float32"):
+        """
+        Image im (2D, 8 ou 16 bits, ou flottante) convertie en float32, en gardant toute sa profondeur.
+        normalize : divise par la valeur maximale du type (voir full_scale), pour avoir des valeurs entre 0 et 1
+        quelle que soit la profondeur ; sinon les niveaux de gris d'origine sont gardés.
+        """
+        out = self.buffer(name, im.shape)
+        scale = 1. / full_scale(im.dtype) if normalize else 1.
+        np.multiply(im, np.float32(scale), out=out, casting="unsafe")
+        return out
+
+    def blur(self, im, sigma, name="blur"):
+        """
+        Flou gaussien d'écart-type sigma de im (float32), écrit dans le buffer name.
+        """
+        return cv.GaussianBlur(im, (0, 0), sigma, dst=self.buffer(name, im.shape, im.dtype))
+
+    def to_uint8(self, im, name="uint8"):
+        """
+        Image im (float32 entre 0 et 1, voir to_float32) quantifiée sur 8 bits, pour les fonctions d'OpenCV qui
+        n'acceptent que du 8 bits (SIFT) : arrondi et saturation, une seule fois, en fin de prétraitement.
+        im est d'abord écrêté sur [0, 1], en place (c'est normalement un buffer du Preprocessor).
+        """
+        # convertScaleAbs prend la valeur absolue : sans écrêtage, une valeur négative (-0.2) deviendrait un gris (51)
+        np.clip(im, 0, 1, out=im)
+        return cv.convertScaleAbs(im, dst=self.buffer(name, im.shape, np.uint8), alpha=255.)
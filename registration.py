@@ -1,7 +1,19 @@
+import hashlib
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+
 import numpy as np
 import cv2 as cv
 
-def find_translation(ref, toTranslate, filenames=True):  
+import phase_correlation
+from feature_cache import FeatureCache
+from preprocessing import Preprocessor
+
+def find_translation(ref, toTranslate, filenames=True, return_diagnostics=False, **options):  
 
     """
     On utilise la methode Scale Invariant Feature Transform (SIFT) pour obtenir des points cle (keypoints) auxquels sont associes des descripteurs. 
@@ -15,60 +27,935 @@ def find_translation(ref, toTranslate, filenames=True):
     
     filenames : bool ; 
     indique si les arguments ref et toTranslate sont des noms de fichier,
-    dans le cas contraire ref et toTranslate doivent être des array numpy de dtype np.uint8
+    dans le cas contraire ref et toTranslate doivent être des array numpy 2D (8 ou 16 bits, ou flottants entre 0 et 1) ;
+    les images sont traitées à pleine profondeur (voir preprocessing.py)
+
+    return_diagnostics : bool ; si True, renvoie le couple (translation, diagnostics), où diagnostics est un objet
+    Diagnostics (temps de chaque étape, nombre de keypoints, de correspondances, taille du cluster, ...)
+
+    options : paramètres transmis à RegistrationSession (method, radius, matcher, ratio, ...), voir help(RegistrationSession)
+    en particulier method="phase" remplace SIFT par une corrélation de phase sur les images 16 bits d'origine,
+    et method="pyramid" fait une estimation grossière sur les images réduites puis l'affine à pleine résolution,
+    method="keyzones" apparie les zones saillantes de la DoG (voir find_keyzones.py)
     """
-    
-    # read images
-    if filenames :
-        ref = cv.imread(ref, cv.IMREAD_GRAYSCALE)
-        toTranslate = cv.imread(toTranslate, cv.IMREAD_GRAYSCALE)
-    
-    # On applique un flou gaussien léger pour atténuer le bruit éventuel de l'image
-    ref = cv.GaussianBlur(ref, [0,0], 1.5)
-    toTranslate = cv.GaussianBlur(toTranslate, [0,0], 1.5)
 
-    # Initialisation de la méthode SIFT
-    sift = cv.SIFT_create()
+    return RegistrationSession(ref, filenames=filenames, **options).register(toTranslate, return_diagnostics)
+
+
+class RegistrationSession:
+
+    """
+    Session de recalage : ce que la méthode calcule sur l'image de référence (keypoints et descripteurs SIFT,
+    spectre, zones saillantes) est calculé une seule fois, à la création de la session, puis réutilisé pour
+    chaque image à recaler.
+
+    Utile lorsque l'on recale beaucoup d'images sur la même référence : on évite de relire,
+    flouter et analyser la référence à chaque appel de find_translation.
+
+    Chaque méthode est implémentée par un backend (SiftBackend, PhaseBackend, PyramidBackend, KeyzonesBackend,
+    CascadeBackend, voir BACKENDS), qui ne reçoit que ses propres options : une option que la méthode choisie
+    n'utilise pas lève TypeError, plutôt que d'être ignorée. method="cascade" accepte les options de chacune
+    des méthodes de la cascade (sauf confidence, fixée à "ratio") et transmet à chacune les siennes.
+
+    Arguments du constructeur :
+
+    ref : numpy array ou string ; image de référence
+
+    filenames : bool ;
+    indique si ref (et les images passées ensuite à register) sont des noms de fichier,
+    dans le cas contraire ce doivent être des array numpy 2D (8 ou 16 bits, ou flottants entre 0 et 1) ;
+    les tableaux flottants en niveaux de gris (entre 0 et 255 ou 0 et 65535) ne sont pas pris en charge :
+    ils sont lus comme des intensités entre 0 et 1, et saturent donc en blanc (les convertir en entiers avant)
+
+    method : "sift", "phase", "pyramid", "keyzones" ou "cascade" ;
+    "sift" : points clé SIFT, correspondances puis clustering des translations (par défaut),
+    "phase" : corrélation de phase (voir phase_correlation.py) sur l'image entière, lue sans conversion en 8 bits ;
+    adaptée aux translations pures, les deux images doivent avoir la même taille
+    "pyramid" : grossier vers fin ; la translation est d'abord estimée par corrélation de phase sur les images
+    réduites d'un facteur 2**pyramid_levels, puis affinée à pleine résolution par corrélation de phase sur la
+    zone de recouvrement prédite, en ne cherchant qu'à refine_radius pixels de l'estimation grossière
+    "keyzones" : zones saillantes de la différence de gaussiennes (composantes connexes du masque), appariées
+    par aires similaires puis vote des translations (voir find_keyzones.py) ; quelques dizaines de zones au lieu
+    de milliers de keypoints, adapté aux échantillons avec poussières ou inclusions
+    "cascade" : on essaie d'abord les méthodes rapides, et on ne passe à la suivante (SIFT en dernier recours)
+    que si la confiance de la précédente est insuffisante, voir cascade
+
+    radius : float ; rayon (en pixels) du voisinage utilisé pour le clustering des translations (method="sift" et "keyzones")
+
+    matcher : "bf" ou "flann" (method="sift") ;
+    "bf" : correspondances par force brute avec vérification croisée (par défaut),
+    "flann" : plus proches voisins approchés (KD-tree de FLANN) filtrés par le test du ratio de Lowe,
+    beaucoup plus rapide lorsque les images ont de nombreux keypoints
+
+    ratio : float ; seuil du test du ratio (matcher="flann") : une correspondance n'est gardée que si
+    son plus proche voisin est nettement plus proche que le second (distance < ratio * distance du second)
+
+    trees, checks : int ; nombre d'arbres du KD-tree et nombre de feuilles visitées par recherche (matcher="flann"),
+    plus checks est grand plus la recherche est précise mais lente
+
+    window : bool ; applique une fenêtre de Hann avant la FFT (method="phase" et "pyramid")
+
+    upsample_factor : int ; précision sous-pixel de la corrélation de phase (method="phase"),
+    la translation est alors renvoyée en flottants, à 1/upsample_factor pixel près
+
+    pyramid_levels : int ; nombre de niveaux de la pyramide (method="pyramid"), 2 pour un facteur 4, 3 pour un facteur 8
+
+    refine_radius : int ou None ; écart maximal (en pixels, à pleine résolution) cherché autour de l'estimation
+    grossière (method="pyramid"), par défaut 2**pyramid_levels
+
+    blur_sigma : float ; écart-type du flou gaussien appliqué avant SIFT (method="sift")
+
+    cache : FeatureCache, string ou None ; cache sur disque des keypoints et descripteurs (method="sift"),
+    une chaîne est interprétée comme le dossier du cache, voir feature_cache.py
+
+    mask : numpy array, "auto" ou None ; zone où SIFT cherche des keypoints (method="sift") ;
+    un array de la taille des images (uint8, non nul = zone utilisée, 0 = zone exclue), appliqué à toutes les images,
+    ou "auto" pour exclure automatiquement le bandeau d'acquisition de chaque image (voir banner_mask)
+
+    max_keypoints : int ou None ; nombre maximal de keypoints gardés par image (method="sift"), répartis sur une grille
+    de grid = (lignes, colonnes) cases (voir spread_keypoints) : les temps de calcul des descripteurs et des
+    correspondances ne dépendent plus de la richesse de l'image
+
+    tile_size : int ou None ; pour les très grandes images (method="sift"), la détection est découpée en tuiles de
+    tile_size x tile_size pixels, traitées en parallèle par workers threads (par défaut, autant que de coeurs) ;
+    chaque tuile est agrandie de tile_overlap pixels de chaque côté pour que les keypoints proches des coutures
+    soient calculés avec tout leur voisinage
+
+    keyzone_params : dict ou None ; paramètres de find_keyzones.keyzones (sigma_inf, sigma_sup, last_blur_sigma,
+    relative_tolerance) pour method="keyzones"
+
+    area_ratio : float ; rapport minimal entre les aires de deux zones appariées (method="keyzones")
+
+    confidence : "height" ou "ratio" ; mesure de la confiance pour method="phase" et "pyramid", voir
+    phase_correlation.translation_from_spectra ; avec "ratio", method="pyramid" donne le rapport des pics de
+    l'étape grossière (la seule qui cherche dans toutes les translations possibles)
+
+    cascade : suite de méthodes essayées dans l'ordre (method="cascade"), ("pyramid", "sift") par défaut ; le backend
+    de chaque méthode reçoit celles des autres options qui le concernent, et n'est créé que la première fois qu'on en
+    a besoin. Le résultat d'une méthode est accepté si sa confiance atteint le seuil : rapport des pics de corrélation
+    (confidence="ratio") d'au moins min_confidence pour "phase" et "pyramid", nombre de translations dans le
+    cluster retenu d'au moins min_support pour "sift" et "keyzones". Celui de la dernière méthode est toujours accepté.
+
+    on_diagnostics : callable, logging.Logger ou None ;
+    si donné, chaque appel à register mesure ses étapes et transmet l'objet Diagnostics obtenu à cette fonction
+    (ou l'écrit dans ce logger, au niveau INFO). Sans on_diagnostics ni return_diagnostics, rien n'est mesuré.
+
+    Après chaque appel à register, l'attribut confidence contient la hauteur du pic de corrélation
+    (entre 0 et 1) pour method="phase" et "pyramid" (pic de l'étape d'affinage), None pour method="sift" et "keyzones",
+    et pour method="cascade" la confiance de la méthode retenue, dont le nom est dans l'attribut used_method.
+    """
+
+    def __init__(self, ref, filenames=True, method="sift", on_diagnostics=None, **options):
+        self.filenames = filenames
+        self.method = method
+        self.confidence = None
+        self.used_method = method
+        if isinstance(on_diagnostics, logging.Logger):
+            logger = on_diagnostics
+            on_diagnostics = lambda diagnostics: logger.info("%s", diagnostics)
+        self.on_diagnostics = on_diagnostics
+        self.backend = make_backend(method, ref, filenames, **options)
+
+    def register(self, toTranslate, return_diagnostics=False):
+        """
+        Renvoie la translation (T_x, T_y) entre l'image de référence de la session et toTranslate
+        (même convention que find_translation), ou le couple (translation, diagnostics) si return_diagnostics est vrai.
+        """
+        diagnostics = Diagnostics(enabled=return_diagnostics or self.on_diagnostics is not None)
+        with diagnostics.stage("total"):
+            translation = self.backend.register(toTranslate, diagnostics)
+        self.confidence = self.backend.confidence
+        self.used_method = self.backend.used_method
+        diagnostics.translation = translation
+        diagnostics.confidence = self.confidence
+        diagnostics.used_method = self.used_method
+
+        if self.on_diagnostics is not None:
+            self.on_diagnostics(diagnostics)
+        return (translation, diagnostics) if return_diagnostics else translation
+
+    def rebase(self):
+        """
+        L'image passée au dernier appel de register devient la référence de la session : ce que la méthode a calculé
+        sur elle (keypoints et descripteurs, spectre, zones) est réutilisé au lieu d'être recalculé.
+        Sert à recaler chaque image sur la précédente (voir drift_tracking.py).
+        """
+        self.backend.rebase()
+
+    def register_many(self, frames):
+        """
+        Recale successivement toutes les images de frames (itérable) sur la référence,
+        renvoie la liste des translations dans le même ordre.
+        """
+        return [self.register(frame) for frame in frames]
+
+
+def make_backend(method, ref, filenames=True, **options):
+    """
+    Crée le backend de la méthode method sur l'image de référence ref, après avoir vérifié ses options
+    (voir check_options).
+    """
+    check_options(method, options)
+    return BACKENDS[method](ref, filenames, **options)
+
+
+def check_options(method, options):
+    """
+    Lève ValueError si method est inconnue, TypeError si options (dictionnaire) contient des paramètres
+    que la méthode n'utilise pas.
+    """
+    if method not in BACKENDS:
+        raise ValueError(f"method inconnue : {method!r} (choisir 'sift', 'phase', 'pyramid', 'keyzones' ou 'cascade')")
+    BACKENDS[method].check_options(options)
+
+
+class Backend:
+
+    """
+    Interface commune des méthodes de recalage : le constructeur reçoit l'image de référence, filenames et les
+    options propres à la méthode, register(toTranslate, diagnostics) renvoie la translation et remplit diagnostics.
+    Après register, confidence contient la confiance du résultat (None si la méthode n'en donne pas), et used_method
+    le nom de la méthode qui l'a obtenu. register garde dans _last ce qu'il a calculé sur l'image à recaler,
+    que _rebase(last) installe comme référence (voir RegistrationSession.rebase).
+    """
+
+    method = None
+
+    def __init__(self, filenames=True):
+        self.filenames = filenames
+        self.confidence = None
+        self.used_method = self.method
+        self._last = None
+
+    @classmethod
+    def accepted_options(cls):
+        # paramètres du constructeur, hors ref et filenames
+        return [name for name, parameter in inspect.signature(cls).parameters.items()
+                if name not in ("ref", "filenames") and parameter.kind == parameter.POSITIONAL_OR_KEYWORD]
+
+    @classmethod
+    def check_options(cls, options):
+        _reject_options(cls.method, options, cls.accepted_options())
+
+    def register(self, toTranslate, diagnostics):
+        raise NotImplementedError
+
+    def rebase(self):
+        if self._last is None:
+            raise ValueError("aucune image recalée : rien à prendre comme référence")
+        self._rebase(self._last)
+        self._last = None
+
+    def _rebase(self, last):
+        raise NotImplementedError
+
+    def _read(self, im, diagnostics=None):
+        diagnostics = diagnostics or Diagnostics(enabled=False)
+        if self.filenames :
+            # lecture à pleine profondeur (16 bits pour nos images MEB)
+            with diagnostics.stage("read"):
+                im = phase_correlation.read_image(im)
+        return im
+
+
+def _reject_options(method, options, accepted):
+    unused = sorted(set(options) - set(accepted))
+    if unused:
+        raise TypeError(f"option(s) sans effet pour method={method!r} : {', '.join(unused)} "
+                        f"(options acceptées : {', '.join(accepted)})")
+
+
+class SiftBackend(Backend):
+
+    """
+    method="sift" : keypoints SIFT, correspondances (force brute ou FLANN) puis clustering des translations.
+    Les keypoints et descripteurs de la référence sont calculés une seule fois.
+    """
+
+    method = "sift"
+
+    def __init__(self, ref, filenames=True, radius=8, matcher="bf", ratio=0.75, trees=5, checks=50, blur_sigma=1.5,
+                 cache=None, mask=None, max_keypoints=None, grid=(4, 4), tile_size=None, tile_overlap=64, workers=None):
+        if matcher not in ("bf", "flann"):
+            raise ValueError(f"matcher inconnu : {matcher!r} (choisir 'bf' ou 'flann')")
+        if isinstance(mask, str) and mask != "auto":
+            raise ValueError(f"mask inconnu : {mask!r} (un array, 'auto' ou None)")
+        super().__init__(filenames)
+        self.radius = radius
+        self.matcher = matcher
+        self.ratio = ratio
+        self.sift = cv.SIFT_create()
+        self.blur_sigma = blur_sigma
+        self.cache = FeatureCache(cache) if isinstance(cache, str) else cache
+        self.mask = mask
+        self.max_keypoints = max_keypoints
+        self.grid = tuple(grid)
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.workers = workers
+        self.trees, self.checks = trees, checks
+        # buffers du prétraitement des images à recaler, réutilisés d'une image à l'autre (la référence a les siens :
+        # elle est traitée dans un autre thread)
+        self._preprocessor = Preprocessor()
+
+        # Les keypoints de la référence sont extraits dans un thread à part (OpenCV libère le GIL) : pendant ce temps,
+        # le premier appel à register extrait ceux de l'image à recaler. On lit quand même la référence tout de suite,
+        # pour qu'une image illisible soit signalée à la création de la session.
+        self._reference = _in_thread(self._reference_features, self._read(ref))
+
+    def _reference_features(self, ref):
+        return self._indexed(*self._features(ref, preprocessor=Preprocessor()))
+
+    def _indexed(self, keypoints, descriptors):
+        flann = None
+        if self.matcher == "flann" and len(descriptors) > 0:
+            # L'index KD-tree est construit une seule fois sur les descripteurs de la référence,
+            # chaque image à recaler vient ensuite l'interroger.
+            flann = cv.FlannBasedMatcher(dict(algorithm=1, trees=self.trees), dict(checks=self.checks))
+            flann.add([descriptors])
+            flann.train()
+        return keypoints, descriptors, flann
 
-    keypoints_1, descriptors_1 = sift.detectAndCompute(ref, None)
-    keypoints_2, descriptors_2 = sift.detectAndCompute(toTranslate, None)
+    # keypoints, descripteurs et index FLANN de la référence (on attend, si besoin, la fin de leur calcul)
+    @property
+    def keypoints(self):
+        return self._reference.result()[0]
 
-    # On fait correspondre les keypoints par méthode force brute
-    bf = cv.BFMatcher(cv.NORM_L1, crossCheck=True)
+    @property
+    def descriptors(self):
+        return self._reference.result()[1]
+
+    @property
+    def flann(self):
+        return self._reference.result()[2]
+
+    def _features(self, im, diagnostics=None, preprocessor=None):
+        """
+        Renvoie les coordonnées (x, y) des keypoints de l'image im (numpy array) (array de taille N x 2)
+        et leurs descripteurs (N x 128).
+        preprocessor : Preprocessor dont les buffers sont utilisés (par défaut celui du backend)
+        """
+        diagnostics = diagnostics or Diagnostics(enabled=False)
+        preprocessor = preprocessor or self._preprocessor
+
+        if self.cache is not None:
+            with diagnostics.stage("cache"):
+                key = self.cache.key(im, self._feature_params())
+                features = self.cache.load(key)
+            if features is not None:
+                return features
+
+        # On applique un flou gaussien léger pour atténuer le bruit éventuel de l'image.
+        # Le flou est calculé en float32 sur l'image à pleine profondeur, et le résultat n'est ramené sur 8 bits
+        # (SIFT d'OpenCV n'accepte que des images 8 bits) qu'une fois, à la fin : le bruit est lissé avant d'être arrondi.
+        with diagnostics.stage("blur"):
+            normalized = preprocessor.to_float32(im, normalize=True)
+            # flou en place, dans le buffer de la conversion
+            blurred = preprocessor.to_uint8(preprocessor.blur(normalized, self.blur_sigma, name="float32"))
+
+        with diagnostics.stage("mask"):
+            mask = banner_mask(im) if isinstance(self.mask, str) else self.mask
+
+        with diagnostics.stage("detect"):
+            keypoints, descriptors = self._detect(blurred, mask)
+            if self.max_keypoints is not None and descriptors is not None:
+                # (sift.compute sur les seuls keypoints gardés reconstruirait toute la pyramide : plus lent)
+                kept = spread_keypoints(keypoints, im.shape, self.max_keypoints, self.grid)
+                keypoints, descriptors = [keypoints[i] for i in kept], descriptors[kept]
+            points = np.array([keypoint.pt for keypoint in keypoints], dtype=np.float32).reshape(-1, 2)
+        if descriptors is None:
+            descriptors = np.zeros((0, self.sift.descriptorSize()), dtype=np.float32)
+
+        if self.cache is not None:
+            with diagnostics.stage("cache"):
+                self.cache.save(key, points, descriptors)
+        return points, descriptors
+
+    def _new_sift(self):
+        # une instance de SIFT par thread, avec les paramètres de self.sift
+        return cv.SIFT_create(self.sift.getNFeatures(), self.sift.getNOctaveLayers(), self.sift.getContrastThreshold(),
+                              self.sift.getEdgeThreshold(), self.sift.getSigma())
+
+    def _detect(self, blurred, mask):
+        """
+        detectAndCompute de SIFT sur l'image entière, ou par tuiles en parallèle (voir tile_size).
+        """
+        height, width = blurred.shape[:2]
+        tile, overlap = self.tile_size, self.tile_overlap
+        if tile is None or (height <= tile and width <= tile):
+            return self._new_sift().detectAndCompute(blurred, mask)
+
+        n_rows, n_cols = -(-height // tile), -(-width // tile)
+
+        def detect_tile(row, col):
+            top, left = row * tile, col * tile
+            y_min, y_max = max(0, top - overlap), min(height, top + tile + overlap)
+            x_min, x_max = max(0, left - overlap), min(width, left + tile + overlap)
+            keypoints, descriptors = self._new_sift().detectAndCompute(
+                blurred[y_min:y_max, x_min:x_max], None if mask is None else mask[y_min:y_max, x_min:x_max])
+            if descriptors is None:
+                return [], descriptors
+            # un keypoint n'est gardé que par la tuile qui le contient (hors marge) : pas de doublons aux coutures
+            kept, shifted = [], []
+            for i, keypoint in enumerate(keypoints):
+                x, y = keypoint.pt[0] + x_min, keypoint.pt[1] + y_min
+                if min(int(y // tile), n_rows - 1) == row and min(int(x // tile), n_cols - 1) == col:
+                    kept.append(i)
+                    shifted.append(cv.KeyPoint(x, y, keypoint.size, keypoint.angle, keypoint.response,
+                                               keypoint.octave, keypoint.class_id))
+            return shifted, descriptors[kept]
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(lambda cell: detect_tile(*cell), [(row, col) for row in range(n_rows) for col in range(n_cols)]))
+        keypoints = [keypoint for tile_keypoints, _ in results for keypoint in tile_keypoints]
+        descriptors = [tile_descriptors for _, tile_descriptors in results if tile_descriptors is not None]
+        return keypoints, np.concatenate(descriptors) if descriptors else None
+
+    def _feature_params(self):
+        # tous les paramètres dont dépendent les keypoints : en changer un invalide les entrées du cache
+        return dict(blur_sigma=self.blur_sigma, preprocessing="float32", opencv=cv.__version__,
+                    nfeatures=self.sift.getNFeatures(), n_octave_layers=self.sift.getNOctaveLayers(),
+                    contrast_threshold=self.sift.getContrastThreshold(), edge_threshold=self.sift.getEdgeThreshold(),
+                    sigma=self.sift.getSigma(), max_keypoints=self.max_keypoints, grid=self.grid,
+                    tile_size=self.tile_size, tile_overlap=self.tile_overlap,
+                    mask=self.mask if self.mask is None or isinstance(self.mask, str)
+                    else hashlib.blake2b(np.ascontiguousarray(self.mask).data, digest_size=20).hexdigest())
+
+    def register(self, toTranslate, diagnostics):
+        keypoints_2, descriptors_2 = self._last = self._features(self._read(toTranslate, diagnostics), diagnostics)
+        # (attente de la fin de l'extraction des keypoints de la référence, au premier appel seulement)
+        with diagnostics.stage("reference"):
+            self._reference.result()
+
+        # On récupère les paires de points associés sur les chaque image.
+        with diagnostics.stage("match"):
+            matches = self._match(descriptors_2)
+
+        # On récupère la translation en x et y pour chacun des points
+        translations = self.keypoints[matches[:,0]].astype(np.float64) - keypoints_2[matches[:,1]]
+
+        with diagnostics.stage("cluster"):
+            translation, cluster_size = cluster_translations(translations, self.radius)
+
+        diagnostics.n_keypoints_ref = len(self.keypoints)
+        diagnostics.n_keypoints = len(keypoints_2)
+        diagnostics.n_matches = len(matches)
+        diagnostics.cluster_size = cluster_size
+        diagnostics.inlier_ratio = cluster_size / len(matches)
+        return translation
+
+    def _rebase(self, last):
+        # seul l'index FLANN est à construire (dans un thread à part, comme pour la référence initiale)
+        self._reference = _in_thread(self._indexed, *last)
+
+    def _match(self, descriptors_2):
+        """
+        Renvoie le tableau (N x 2) des couples (indice du keypoint de la référence, indice du keypoint de l'image à recaler)
+        mis en correspondance.
+        """
+        if len(self.descriptors) == 0 or len(descriptors_2) == 0:
+            # image sans keypoint (uniforme, ...) : aucune correspondance, cluster_translations lèvera ValueError
+            # (BFMatcher.match échouerait sur une assertion d'OpenCV peu parlante)
+            return np.zeros((0, 2), dtype=np.intp)
+        if self.matcher == "bf":
+            # On fait correspondre les keypoints par méthode force brute
+            bf = cv.BFMatcher(cv.NORM_L1, crossCheck=True)
+            matches = bf.match(self.descriptors, descriptors_2)
+            return np.array([(match.queryIdx, match.trainIdx) for match in matches], dtype=np.intp).reshape(-1, 2)
+
+        # Avec FLANN, ce sont les descripteurs de l'image à recaler qui interrogent l'index de la référence :
+        # on garde les deux plus proches voisins pour le test du ratio.
+        knn_matches = self.flann.knnMatch(descriptors_2, k=2)
+        return np.array([(m[0].trainIdx, m[0].queryIdx) for m in knn_matches
+                         if len(m) == 2 and m[0].distance < self.ratio * m[1].distance], dtype=np.intp).reshape(-1, 2)
+
+class PhaseBackend(Backend):
+
+    """
+    method="phase" : corrélation de phase sur l'image entière ; le spectre de la référence est calculé une seule fois.
+    """
 
-    matches = bf.match(descriptors_1,descriptors_2)
+    method = "phase"
 
-    # On récupère les paires de points associés sur les chaque image. 
-    pairs = np.array([[keypoints_1[match.queryIdx].pt, keypoints_2[match.trainIdx].pt] for match in matches])
+    def __init__(self, ref, filenames=True, window=True, upsample_factor=1, confidence="height"):
+        super().__init__(filenames)
+        self.window = window
+        self.upsample_factor = upsample_factor
+        self.confidence_mode = confidence
+        self.ref_spectrum = self._spectrum(ref)
 
-    # On récupère la translation en x et y pour chacun des points
-    translations = pairs[:,0] - pairs[:,1]
+    def _spectrum(self, im, diagnostics=None):
+        diagnostics = diagnostics or Diagnostics(enabled=False)
+        im = self._read(im, diagnostics)
+        with diagnostics.stage("fft"):
+            return phase_correlation.spectrum(im, self.window)
 
+    def register(self, toTranslate, diagnostics):
+        spectrum = self._last = self._spectrum(toTranslate, diagnostics)
+        with diagnostics.stage("correlation"):
+            translation, self.confidence = phase_correlation.translation_from_spectra(
+                self.ref_spectrum, spectrum, self.upsample_factor, confidence=self.confidence_mode)
+        return translation
+
+    def _rebase(self, last):
+        self.ref_spectrum = last
+
+
+class PyramidBackend(Backend):
+
+    """
+    method="pyramid" : corrélation de phase sur les images réduites, puis affinage à pleine résolution
+    (voir refine_translation).
+    """
+
+    method = "pyramid"
+
+    def __init__(self, ref, filenames=True, window=True, pyramid_levels=2, refine_radius=None, confidence="height"):
+        super().__init__(filenames)
+        self.window = window
+        self.pyramid_levels = pyramid_levels
+        self.refine_radius = 2**pyramid_levels if refine_radius is None else refine_radius
+        self.confidence_mode = confidence
+        # on garde la référence pleine résolution (pour l'affinage) et le spectre de sa version réduite
+        self.ref_image = self._read(ref)
+        self.ref_spectrum = phase_correlation.spectrum(downsample(self.ref_image, pyramid_levels), window)
+
+    def register(self, toTranslate, diagnostics):
+        im = self._read(toTranslate, diagnostics)
+        with diagnostics.stage("coarse"):
+            coarse_spectrum = phase_correlation.spectrum(downsample(im, self.pyramid_levels), self.window)
+            self._last = im, coarse_spectrum
+            coarse_translation, coarse_confidence = phase_correlation.translation_from_spectra(
+                self.ref_spectrum, coarse_spectrum, confidence=self.confidence_mode)
+        with diagnostics.stage("refine"):
+            translation, self.confidence = refine_translation(
+                self.ref_image, im, coarse_translation * 2**self.pyramid_levels, self.refine_radius, self.window)
+        if self.confidence_mode == "ratio":
+            self.confidence = coarse_confidence
+        return translation
+
+    def _rebase(self, last):
+        self.ref_image, self.ref_spectrum = last
+
+
+class KeyzonesBackend(Backend):
+
+    """
+    method="keyzones" : appariement des zones saillantes de la DoG (voir find_keyzones.py) ; les zones de la référence
+    sont calculées une seule fois.
+    """
+
+    method = "keyzones"
+
+    def __init__(self, ref, filenames=True, radius=8, keyzone_params=None, area_ratio=0.5):
+        # import local : find_keyzones importe lui-même registration (et matplotlib)
+        import find_keyzones
+        super().__init__(filenames)
+        self.keyzones = find_keyzones
+        self.keyzone_params = keyzone_params or {}
+        self.area_ratio = area_ratio
+        self.radius = radius
+        # buffers de la DoG (scale_space.ScaleSpace), réutilisés d'une image à l'autre
+        self._preprocessor = Preprocessor()
+        self.ref_zones = self._zones(ref)
+
+    def _zones(self, im, diagnostics=None):
+        diagnostics = diagnostics or Diagnostics(enabled=False)
+        im = self._read(im, diagnostics)
+        with diagnostics.stage("zones"):
+            return self.keyzones.keyzones(im, preprocessor=self._preprocessor, **self.keyzone_params)
+
+    def register(self, toTranslate, diagnostics):
+        zones = self._last = self._zones(toTranslate, diagnostics)
+        with diagnostics.stage("match"):
+            translation, cluster_size, n_pairs = self.keyzones.match_zones(self.ref_zones, zones, self.area_ratio,
+                                                                           self.radius)
+        # les zones jouent le rôle des keypoints, les paires candidates celui des correspondances,
+        # et les zones retrouvées par la vérification celui du cluster
+        diagnostics.n_keypoints_ref = len(self.ref_zones[0])
+        diagnostics.n_keypoints = len(zones[0])
+        diagnostics.n_matches = n_pairs
+        diagnostics.cluster_size = cluster_size
+        diagnostics.inlier_ratio = cluster_size / n_pairs
+        return translation
+
+    def _rebase(self, last):
+        self.ref_zones = last
+
+
+class CascadeBackend(Backend):
+
+    """
+    method="cascade" : les méthodes de cascade sont essayées dans l'ordre, jusqu'à ce que l'une d'elles soit
+    assez confiante (voir RegistrationSession). Chacune a son backend, créé la première fois qu'on en a besoin,
+    avec celles des options qui la concernent.
+    """
+
+    method = "cascade"
+
+    def __init__(self, ref, filenames=True, cascade=("pyramid", "sift"), min_confidence=3., min_support=6, **options):
+        if not cascade or any(method not in BACKENDS or method == "cascade" for method in cascade):
+            raise ValueError(f"cascade invalide : {cascade!r}")
+        super().__init__(filenames)
+        self.cascade = tuple(cascade)
+        self.min_confidence = min_confidence
+        self.min_support = min_support
+        self.ref = ref
+        # options de chaque méthode (les méthodes à base de corrélation de phase donnent le rapport des pics)
+        self.options = {}
+        for method in self.cascade:
+            accepted = BACKENDS[method].accepted_options()
+            self.options[method] = {name: value for name, value in options.items() if name in accepted}
+            if "confidence" in accepted:
+                self.options[method]["confidence"] = "ratio"
+        # la première méthode sert à chaque image : on prépare son backend tout de suite
+        self.backends = {}
+        self._backend(self.cascade[0])
+
+    @classmethod
+    def accepted_options(cls, cascade=("pyramid", "sift")):
+        # options propres, et celles des méthodes de la cascade (sauf confidence, imposée)
+        accepted = super().accepted_options()
+        for method in cascade:
+            if method in BACKENDS and method != "cascade":
+                accepted += [name for name in BACKENDS[method].accepted_options()
+                             if name != "confidence" and name not in accepted]
+        return accepted
+
+    @classmethod
+    def check_options(cls, options):
+        _reject_options(cls.method, options, cls.accepted_options(options.get("cascade", ("pyramid", "sift"))))
+
+    def _backend(self, method):
+        if method not in self.backends:
+            self.backends[method] = BACKENDS[method](self.ref, self.filenames, **self.options[method])
+        return self.backends[method]
+
+    def register(self, toTranslate, diagnostics):
+        # méthodes qui ont recalé toTranslate (pour rebase)
+        self._last = toTranslate, []
+        for k, method in enumerate(self.cascade):
+            last = k == len(self.cascade) - 1
+            stage_diagnostics = Diagnostics(enabled=diagnostics.enabled)
+            try:
+                backend = self._backend(method)
+                with stage_diagnostics.stage("total"):
+                    translation = backend.register(toTranslate, stage_diagnostics)
+            except (ValueError, cv.error) as e:
+                # une méthode rapide qui échoue (images de tailles différentes pour la corrélation de phase,
+                # aucune zone compatible, ...) passe la main à la suivante ; l'erreur est gardée dans les diagnostics.
+                # Les autres exceptions (fichier illisible, bug, ...) ne sont pas propres à la méthode : elles remontent.
+                if last:
+                    raise
+                diagnostics.skipped[method] = f"{type(e).__name__}: {e}"
+                continue
+            self._last[1].append(method)
+            # temps des étapes de chaque méthode, préfixés par son nom
+            if diagnostics.enabled:
+                for name, t in stage_diagnostics.times.items():
+                    diagnostics.times[f"{method}.{name}"] = t
+            if method in ("phase", "pyramid"):
+                self.confidence = backend.confidence
+                accepted = self.confidence >= self.min_confidence
+            else:
+                self.confidence = stage_diagnostics.cluster_size
+                accepted = self.confidence >= self.min_support
+            if accepted or last:
+                break
+        self.used_method = method
+        for name in ("n_keypoints_ref", "n_keypoints", "n_matches", "cluster_size", "inlier_ratio"):
+            setattr(diagnostics, name, getattr(stage_diagnostics, name))
+        return translation
+
+    def _rebase(self, last):
+        # les backends qui ont recalé la nouvelle référence la reprennent ; les autres seront recréés dessus au besoin
+        self.ref, methods = last
+        for method in list(self.backends):
+            if method in methods:
+                self.backends[method].rebase()
+            else:
+                del self.backends[method]
+
+
+# backend de chaque méthode
+BACKENDS = {backend.method: backend for backend in (SiftBackend, PhaseBackend, PyramidBackend, KeyzonesBackend,
+                                                    CascadeBackend)}
+
+
+def _in_thread(function, *args):
+    """
+    Lance function(*args) dans un nouveau thread, et renvoie un Future de son résultat.
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def downsample(im, levels):
+    """
+    Réduit l'image d'un facteur 2**levels (moyenne sur des blocs de pixels, ce qui évite le repliement).
+    """
+    factor = 2**levels
+    return cv.resize(im, (im.shape[1] // factor, im.shape[0] // factor), interpolation=cv.INTER_AREA)
+
+
+def banner_mask(im, min_fraction=0.5, min_height=4, max_height_fraction=1/3):
+    """
+    Masque (uint8, 255 = image, 0 = bandeau) excluant le bandeau d'informations des images MEB (tension, grossissement,
+    barre d'échelle, ...), ou None si l'image n'en a pas.
+
+    Le bandeau est un bloc de lignes, en bas ou en haut de l'image, sur un fond de couleur constante : on cherche
+    depuis chaque bord les lignes dont au moins min_fraction des pixels ont exactement la valeur médiane de la ligne
+    (ce qui n'arrive pas sur une image MEB, bruitée). On ne retient un bandeau que s'il fait au moins min_height lignes,
+    et on ne cherche pas au-delà de max_height_fraction de la hauteur de l'image.
+    """
+    height = im.shape[0]
+    n_rows = int(height * max_height_fraction)
+
+    def banner_height(rows):
+        # rows : lignes en partant du bord
+        median = np.median(rows, axis=1).reshape(-1, 1)
+        constant = np.count_nonzero(rows == median, axis=1) >= min_fraction * rows.shape[1]
+        # nombre de lignes "constantes" consécutives depuis le bord
+        n = len(constant) if constant.all() else int(np.argmin(constant))
+        return n if n >= min_height else 0
+
+    bottom = banner_height(im[::-1][:n_rows])
+    top = banner_height(im[:n_rows])
+    if top == 0 and bottom == 0:
+        return None
+    mask = np.full(im.shape[:2], 255, dtype=np.uint8)
+    mask[:top] = 0
+    mask[height - bottom:] = 0
+    return mask
+
+
+def spread_keypoints(keypoints, shape, max_keypoints, grid=(4, 4)):
+    """
+    Indices (triés) d'au plus max_keypoints keypoints, répartis sur une grille de grid = (lignes, colonnes) cases
+    de l'image de taille shape : chaque case reçoit la même part, remplie par ses keypoints de plus forte réponse ;
+    la part des cases qui n'ont pas assez de keypoints est redistribuée aux autres.
+    """
+    if len(keypoints) <= max_keypoints:
+        return np.arange(len(keypoints))
+    points = np.array([keypoint.pt for keypoint in keypoints])
+    responses = np.array([keypoint.response for keypoint in keypoints])
+    rows = np.minimum((points[:,1] * grid[0] / shape[0]).astype(np.intp), grid[0] - 1)
+    cols = np.minimum((points[:,0] * grid[1] / shape[1]).astype(np.intp), grid[1] - 1)
+    cells = rows * grid[1] + cols
+
+    # rang de chaque keypoint dans sa case, par réponse décroissante
+    order = np.lexsort((-responses, cells))
+    starts = np.searchsorted(cells[order], cells[order])
+    ranks = np.empty(len(keypoints), dtype=np.intp)
+    ranks[order] = np.arange(len(keypoints)) - starts
+
+    # on prend tous les keypoints de rang 0 (le meilleur de chaque case), puis de rang 1, etc.
+    kept = np.lexsort((-responses, ranks))[:max_keypoints]
+    return np.sort(kept)
+
+
+def refine_translation(ref, im, translation, max_shift, window=True, patch_size=512):
+    """
+    Affine une estimation entière de la translation (T_x, T_y) entre ref et im (numpy arrays) :
+    on découpe dans les deux images la zone de recouvrement prédite par l'estimation, puis on cherche
+    par corrélation de phase l'écart résiduel, limité à max_shift pixels dans chaque direction.
+    La corrélation est faite sur une fenêtre d'au plus patch_size x patch_size pixels au centre du recouvrement.
+
+    Renvoie le couple (translation affinée, confiance), voir phase_correlation.translation_from_spectra.
+    """
+    t_x, t_y = int(translation[0]), int(translation[1])
+
+    # zone de recouvrement dans ref (ref[x,y] = im[x-T_x, y-T_y])
+    x_min, x_max = max(0, t_x), min(ref.shape[1], im.shape[1] + t_x)
+    y_min, y_max = max(0, t_y), min(ref.shape[0], im.shape[0] + t_y)
+    if x_max - x_min <= 2 * max_shift or y_max - y_min <= 2 * max_shift:
+        # recouvrement trop petit pour affiner quoi que ce soit
+        return np.array([t_x, t_y], dtype=np.int32), 0.
+
+    # on se limite à une fenêtre de taille patch_size au centre du recouvrement : l'écart résiduel
+    # étant petit, inutile de corréler toute l'image
+    x_min, y_min = max(x_min, (x_min + x_max - patch_size) // 2), max(y_min, (y_min + y_max - patch_size) // 2)
+    x_max, y_max = min(x_max, x_min + patch_size), min(y_max, y_min + patch_size)
+
+    ref_overlap = ref[y_min:y_max, x_min:x_max]
+    im_overlap = im[y_min - t_y:y_max - t_y, x_min - t_x:x_max - t_x]
+
+    residual, confidence = phase_correlation.phase_correlation(ref_overlap, im_overlap, window, max_shift=max_shift)
+    return np.array([t_x, t_y], dtype=np.int32) + residual, confidence
+
+
+class Diagnostics:
+
+    """
+    Mesures d'un appel à RegistrationSession.register :
+
+    times : dictionnaire étape -> temps passé (en secondes) ; étapes "read", "cache", "blur", "mask", "detect",
+    "reference" (attente des keypoints de la référence, calculés en parallèle), "match",
+    "cluster" pour method="sift", "read", "fft", "correlation" pour method="phase", "read", "coarse", "refine"
+    pour method="pyramid", "read", "zones", "match" pour method="keyzones", et "total" pour l'appel entier
+
+    n_keypoints_ref, n_keypoints : nombre de keypoints (ou de zones, method="keyzones") de la référence et de l'image à recaler
+    n_matches : nombre de correspondances (de paires de zones candidates, method="keyzones")
+    cluster_size : nombre de translations dans le cluster retenu
+    inlier_ratio : cluster_size / n_matches
+    (ces cinq attributs valent None pour les méthodes sans keypoints)
+
+    translation, confidence : résultat de register et confiance (voir RegistrationSession)
+
+    used_method : méthode qui a donné la translation (utile pour method="cascade", dont les temps
+    sont alors préfixés par le nom de la méthode : "pyramid.coarse", "sift.detect", ...)
+
+    skipped : dictionnaire méthode -> erreur ("ValueError: ...") des méthodes de la cascade qui ont échoué et passé
+    la main à la suivante (method="cascade")
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.times = {}
+        self.n_keypoints_ref = self.n_keypoints = self.n_matches = None
+        self.cluster_size = self.inlier_ratio = None
+        self.translation = self.confidence = None
+        self.used_method = None
+        self.skipped = {}
+
+    def stage(self, name):
+        """
+        Contexte mesurant le temps passé dans l'étape name (cumulé si l'étape est traversée plusieurs fois).
+        Ne fait rien si les diagnostics sont désactivés.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.) + time.perf_counter() - start
+
+    def __repr__(self):
+        times = ", ".join(f"{name}={1000 * t:.1f}ms" for name, t in self.times.items())
+        counts = ", ".join(f"{name}={getattr(self, name)}" for name in
+                           ("n_keypoints_ref", "n_keypoints", "n_matches", "cluster_size") if getattr(self, name) is not None)
+        translation = None if self.translation is None else tuple(np.asarray(self.translation).tolist())
+        skipped = ", ".join(f"{method} ignorée ({error})" for method, error in self.skipped.items())
+        return (f"Diagnostics(translation={translation}, method={self.used_method}, {times}"
+                + (f", {counts}" if counts else "") + (f", {skipped}" if skipped else "") + ")")
+
+
+def best_translation(translations, radius=8):
+    """
+    Translation entière (T_x, T_y) autour de laquelle les translations (array N x 2) sont les plus denses,
+    voir cluster_translations.
+    """
+    return cluster_translations(translations, radius)[0]
+
+
+def cluster_translations(translations, radius=8):
+    """
+    Renvoie le couple (translation, nombre de translations dans le cluster retenu).
+    Lève ValueError si translations est vide (aucune correspondance).
+    """
+    translations = np.asarray(translations, dtype=np.float64).reshape(-1, 2)
+    if len(translations) == 0:
+        raise ValueError("aucune translation à regrouper : pas de correspondance entre les deux images")
 
     # Clustering pour trouver la translation optimale dans l'espace des translations en 2D
     # On cherche la zone de l'espace des translations qui est très dense en points
-    
-    # Pour cela, on cherche la translation T0 qui a le plus grand nombre de voisins dans 
-    # un rayon de 8 pixels autour d'elle
 
-    x_trans, y_trans = translations.T
-    
-    # matrice des distances au carré
-    dist_squared = (x_trans - x_trans.reshape(-1,1))**2 + (y_trans - y_trans.reshape(-1,1))**2
-    
-    mask = dist_squared < 64
-    most_neighbours_index = mask.sum(axis=0).argmax()
-    
-    # on détermine la translation entre les deux images en faisant la moyenne 
-    # des translations voisines de T0
-    neighbours_mask = mask[most_neighbours_index]
-    neighbours_translations = translations[neighbours_mask]
+    # Pour cela, on cherche la translation T0 qui a le plus grand nombre de voisins dans
+    # un rayon de `radius` pixels autour d'elle (8 pixels par défaut)
+
+    # Plutôt que de calculer la matrice de toutes les distances (N² flottants), on range les
+    # translations dans une grille fine, de cases de côté radius / 4 (vote par case). Pour une case donnée :
+    # - les cases "intérieures" sont entièrement à moins de radius de tous ses points : tous leurs points sont
+    #   des voisins, comptés d'un coup, sans calcul de distance ;
+    # - les cases "du bord" ne sont qu'en partie à moins de radius : seules leurs distances sont calculées ;
+    # - les autres cases ne contiennent aucun voisin.
+    # Quand la plupart des translations tombent dans un cluster serré (cas normal : beaucoup d'inliers), le cluster
+    # est dans les cases intérieures les unes des autres, et il ne reste que les quelques points du bord à
+    # comparer : le temps et la mémoire restent à peu près linéaires en N.
+    fine = 4
+    cells = np.floor(translations * (fine / radius)).astype(np.int64)
+    # décalages (en cases) des cases du bord et des cases intérieures, avec une marge sur les seuils :
+    # distance minimale entre les deux cases <= radius (le seuil suivant, sqrt(17)/4 radius, est bien au-delà),
+    # distance maximale <= sqrt(13)/4 radius (le seuil suivant, sqrt(16)/4 = radius, serait limite)
+    reach = fine + 1
+    di, dj = np.mgrid[-reach:reach+1, -reach:reach+1].reshape(2, -1)
+    near = np.maximum(np.abs(di) - 1, 0)**2 + np.maximum(np.abs(dj) - 1, 0)**2 <= fine**2
+    inner = (np.abs(di) + 1)**2 + (np.abs(dj) + 1)**2 < fine**2
+    cells -= cells.min(axis=0) - reach
+    # numéro de case linéaire (la marge de reach évite qu'une case voisine "déborde" sur une autre ligne)
+    n_cols = cells[:,1].max() + reach + 1
+    cell_ids = cells[:,0] * n_cols + cells[:,1]
+
+    # points triés par case : la case keys[k] contient les points order[starts[k]:starts[k]+counts[k]]
+    order = np.argsort(cell_ids, kind='stable')
+    keys, starts, counts = np.unique(cell_ids[order], return_index=True, return_counts=True)
+
+    def neighbour_cells(offsets):
+        # indices (dans keys) des cases voisines de chaque case pour ces décalages, -1 si la case est vide
+        neighbour_ids = keys.reshape(-1,1) + offsets
+        indices = np.searchsorted(keys, neighbour_ids).clip(max=len(keys)-1)
+        indices[keys[indices] != neighbour_ids] = -1
+        return indices
+
+    inner_cells = neighbour_cells(di[inner] * n_cols + dj[inner])
+    border_cells = neighbour_cells(di[near & ~inner] * n_cols + dj[near & ~inner])
+    # nombre de voisins sûrs (cases intérieures) et majorant (toutes les cases proches) pour chaque point d'une case
+    inner_counts = np.where(inner_cells >= 0, counts[inner_cells], 0).sum(axis=1)
+    upper_bounds = inner_counts + np.where(border_cells >= 0, counts[border_cells], 0).sum(axis=1)
+
+    def points_of(cells_k):
+        cells_k = cells_k[cells_k >= 0]
+        if len(cells_k) == 0:
+            return np.zeros(0, dtype=np.intp)
+        return np.sort(np.concatenate([order[starts[c]:starts[c]+counts[c]] for c in cells_k]))
+
+    # On évalue exactement les cases par majorant décroissant, et on s'arrête dès que le
+    # majorant ne peut plus battre (ou égaler) le meilleur point trouvé.
+    most_neighbours, most_neighbours_index = -1, -1
+    for k in np.argsort(-upper_bounds, kind='stable'):
+        if upper_bounds[k] < most_neighbours:
+            break
+        points = order[starts[k]:starts[k]+counts[k]]
+        border = translations[points_of(border_cells[k])]
+        # par paquets, pour borner la mémoire (paquet x points du bord) même si le bord contient beaucoup de points
+        chunk_size = max(1, 2**20 // max(len(border), 1))
+        for chunk in np.array_split(points, -(-len(points) // chunk_size)):
+            x_chunk, y_chunk = translations[chunk].T
+            dist_squared = (border[:,0] - x_chunk.reshape(-1,1))**2 + (border[:,1] - y_chunk.reshape(-1,1))**2
+            n_neighbours = inner_counts[k] + (dist_squared < radius**2).sum(axis=1)
+            # à égalité, on garde le plus petit indice (comme argmax sur la matrice complète)
+            best = n_neighbours.max()
+            index = chunk[n_neighbours == best].min()
+            if best > most_neighbours or (best == most_neighbours and index < most_neighbours_index):
+                most_neighbours, most_neighbours_index = best, index
+
+    # on détermine la translation entre les deux images en faisant la moyenne
+    # des translations voisines de T0 (dans l'ordre des indices, comme avec la matrice complète)
+    k = np.searchsorted(keys, cell_ids[most_neighbours_index])
+    candidates_index = points_of(np.concatenate([inner_cells[k], border_cells[k]]))
+    x_0, y_0 = translations[most_neighbours_index]
+    x_trans, y_trans = translations[candidates_index].T
+    neighbours_mask = (x_trans - x_0)**2 + (y_trans - y_0)**2 < radius**2
+    neighbours_translations = translations[candidates_index[neighbours_mask]]
 
     best_translation = neighbours_translations.mean(axis=0).round().astype(np.int32)
 
-    return best_translation
+    return best_translation, len(neighbours_translations)
 
 
 if __name__=="__main__":
     help(find_translation)
-    print(find_translation("Nickel/Ref1.tif", "Nickel/ToBeAligned1.tif"))
\ No newline at end of file
+    print(find_translation("Nickel/Ref1.tif", "Nickel/ToBeAligned1.tif"))
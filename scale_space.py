@@ -0,0 +1,185 @@
+# Espace d'échelle gaussien partagé pour les différences de gaussiennes (DoG).
+#
+# find_keyzones.py et DoG_interactive_parameters.py floutent l'image entière deux fois, à partir de zéro,
+# pour chaque couple (sigma_inf, sigma_sup), avec des sigmas grands (9/10, 58/60.7). Ici on construit la
+# pile de flous une fois par image, et on la réutilise pour tous les couples de sigmas demandés :
+#
+# - flou incrémental : flouter avec sigma_1 puis avec sqrt(sigma_2² - sigma_1²) revient à flouter avec sigma_2,
+#   donc chaque nouveau sigma part du plus grand flou déjà calculé, avec un petit noyau
+# - sous-échantillonnage : une image floutée avec un grand sigma ne contient plus de hautes fréquences, on peut
+#   donc la calculer sur l'image réduite d'un facteur 2**k (avec un sigma divisé par 2**k), ce qui coûte 4**k fois
+#   moins cher. La DoG est calculée à ce niveau puis ré-agrandie à la taille de l'image.
+#
+# Au-dessus de cette pile, sweep évalue automatiquement des jeux de paramètres sur plusieurs images, en comptant
+# les composantes connexes "stables" du masque de la DoG, pour remplacer le réglage à la main avec les sliders.
+#
+# Exemple : python scale_space.py SE1.tif SE2.tif SE3.tif --sigma-inf 9 20 40 58 --sigma-diff 1 2.7 5
+
+import argparse
+import itertools
+
+import numpy as np
+import cv2 as cv
+
+
+class ScaleSpace:
+
+    """
+    Pile de flous gaussiens d'une image.
+
+    im : numpy array 2D (8 ou 16 bits, ou flottant), converti en float32 : la DoG peut être négative
+
+    min_level_sigma : on calcule un flou sur l'image réduite d'un facteur 2**k tant que sigma / 2**k reste
+    supérieur à min_level_sigma (en dessous, le sous-échantillonnage dégraderait le flou)
+
+    max_level : nombre maximal de réductions d'un facteur 2
+
+    preprocessor : Preprocessor ou None (voir preprocessing.py) ; si donné, la conversion en float32, les flous et
+    les DoG sont écrits dans ses buffers, réutilisés d'une image à l'autre : pour une série d'images de même taille,
+    créer une ScaleSpace par image avec le même preprocessor. Une DoG renvoyée est alors écrasée par la DoG suivante,
+    et la pile par la ScaleSpace suivante (les copier s'il faut les garder). Sans preprocessor, chaque résultat
+    est un nouveau tableau.
+    """
+
+    def __init__(self, im, min_level_sigma=4., max_level=4, preprocessor=None):
+        self.shape = im.shape
+        self.min_level_sigma = min_level_sigma
+        self.max_level = max_level
+        self._preprocessor = preprocessor
+
+        # on complète l'image (par symétrie) pour que ses dimensions soient divisibles par 2**max_level :
+        # les pixels de tous les niveaux tombent alors exactement sur des blocs de pixels de l'image d'origine
+        factor = 2**max_level
+        pad_bottom, pad_right = -im.shape[0] % factor, -im.shape[1] % factor
+        im = preprocessor.to_float32(im) if preprocessor is not None else im.astype(np.float32)
+        padded_shape = (im.shape[0] + pad_bottom, im.shape[1] + pad_right)
+        im = cv.copyMakeBorder(im, 0, pad_bottom, 0, pad_right, cv.BORDER_REFLECT, dst=self._buffer("level0", padded_shape))
+        self._levels = {0: im}
+        # pour chaque niveau, liste triée des (sigma, image floutée) déjà calculés ; sigma en pixels de l'image d'origine
+        self._stacks = {}
+
+    def _buffer(self, name, shape):
+        # buffer float32 du preprocessor, ou None (OpenCV alloue alors le résultat)
+        if self._preprocessor is None:
+            return None
+        return self._preprocessor.buffer(f"scale_space.{name}", shape)
+
+    def level(self, sigma):
+        """
+        Niveau (réduction d'un facteur 2**k) auquel on calcule le flou de paramètre sigma.
+        """
+        k = 0
+        while k < self.max_level and sigma / 2**(k + 1) >= self.min_level_sigma:
+            k += 1
+        return k
+
+    def _level_image(self, k):
+        if k not in self._levels:
+            # moyenne sur des blocs de 2**k x 2**k pixels
+            full = self._levels[0]
+            self._levels[k] = cv.resize(full, (full.shape[1] >> k, full.shape[0] >> k),
+                                        dst=self._buffer(f"level{k}", (full.shape[0] >> k, full.shape[1] >> k)),
+                                        interpolation=cv.INTER_AREA)
+        return self._levels[k]
+
+    def gaussian(self, sigma, k=None):
+        """
+        Image floutée avec un écart-type sigma (en pixels de l'image d'origine), au niveau k (par défaut level(sigma)).
+        L'image renvoyée est de taille réduite d'un facteur 2**k (et complétée, voir __init__).
+        """
+        if k is None:
+            k = self.level(sigma)
+        if k not in self._stacks:
+            # la moyenne sur des blocs de n pixels est déjà un flou, de variance (n² - 1) / 12
+            self._stacks[k] = [(np.sqrt((4**k - 1) / 12), self._level_image(k))]
+        stack = self._stacks[k]
+
+        if sigma < stack[0][0]:
+            raise ValueError(f"sigma={sigma} trop petit pour le niveau {k}")
+        # on part du plus grand flou déjà calculé qui ne dépasse pas sigma
+        i = max(i for i, (s, _) in enumerate(stack) if s <= sigma)
+        start_sigma, start = stack[i]
+        if sigma - start_sigma < 1e-6:
+            return start
+
+        increment = np.sqrt(sigma**2 - start_sigma**2) / 2**k
+        blurred = cv.GaussianBlur(start, (0, 0), increment, dst=self._buffer(f"gaussian{k}_{sigma!r}", start.shape))
+        stack.insert(i + 1, (sigma, blurred))
+        return blurred
+
+    def DoG(self, sigma_inf, sigma_sup, last_blur_sigma=0.):
+        """
+        Différence de gaussiennes flou(sigma_inf) - flou(sigma_sup), à la taille de l'image d'origine,
+        suivie d'un flou de last_blur_sigma (si > 0) pour limiter le bruit.
+        """
+        # les deux flous au même niveau, celui du plus petit sigma
+        k = self.level(min(sigma_inf, sigma_sup))
+        inf = self.gaussian(sigma_inf, k)
+        diff = cv.subtract(inf, self.gaussian(sigma_sup, k), dst=self._buffer(f"diff{k}", inf.shape))
+        if k > 0:
+            full = self._levels[0]
+            diff = cv.resize(diff, (full.shape[1], full.shape[0]), dst=self._buffer("diff", full.shape),
+                             interpolation=cv.INTER_LINEAR)
+        diff = diff[:self.shape[0], :self.shape[1]]
+        if last_blur_sigma > 0:
+            diff = cv.GaussianBlur(diff, (0, 0), last_blur_sigma, dst=self._buffer("DoG", self.shape))
+        return diff
+
+
+def mask(DoG_im, tolerance_threshold):
+    """
+    Masque des points les plus saillants : ceux dont la DoG est à moins de tolerance_threshold de son maximum.
+    """
+    return (DoG_im > DoG_im.max() - tolerance_threshold).astype(np.uint8)
+
+
+def stable_components(DoG_im, DoG_perturbed, tolerance_threshold):
+    """
+    Nombre de composantes connexes du masque de DoG_im qui se retrouvent (au moins en partie) dans le masque
+    de DoG_perturbed, DoG calculée avec des sigmas légèrement différents : une zone qui disparaît dès qu'on
+    bouge un peu les paramètres n'est pas un repère fiable.
+    """
+    n, labels = cv.connectedComponents(mask(DoG_im, tolerance_threshold))
+    kept = np.unique(labels[mask(DoG_perturbed, tolerance_threshold) > 0])
+    return int(np.count_nonzero(kept))
+
+
+def sweep(images, sigma_pairs, tolerances, last_blur_sigma=3., perturbation=0.05):
+    """
+    Évalue tous les jeux de paramètres (sigma_inf, sigma_sup, tolerance) sur les images (numpy arrays 2D).
+
+    Le score d'un jeu de paramètres est le nombre moyen, sur les images, de composantes connexes stables
+    (voir stable_components, avec des sigmas multipliés par 1 + perturbation).
+    Renvoie la liste des jeux de paramètres (dictionnaires), du meilleur score au moins bon.
+    """
+    counts = {}
+    for im in images:
+        scale_space = ScaleSpace(im)
+        for sigma_inf, sigma_sup in sigma_pairs:
+            DoG_im = scale_space.DoG(sigma_inf, sigma_sup, last_blur_sigma)
+            DoG_perturbed = scale_space.DoG(sigma_inf * (1 + perturbation), sigma_sup * (1 + perturbation), last_blur_sigma)
+            for tolerance in tolerances:
+                counts.setdefault((sigma_inf, sigma_sup, tolerance), []).append(
+                    stable_components(DoG_im, DoG_perturbed, tolerance))
+
+    results = [dict(sigma_inf=sigma_inf, sigma_sup=sigma_sup, tolerance=tolerance,
+                    score=float(np.mean(c)), counts=c)
+               for (sigma_inf, sigma_sup, tolerance), c in counts.items()]
+    return sorted(results, key=lambda result: result["score"], reverse=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recherche automatique des paramètres de la DoG")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--sigma-inf", nargs="+", type=float, default=[5, 9, 20, 40, 58])
+    parser.add_argument("--sigma-diff", nargs="+", type=float, default=[1, 2.7, 5], help="valeurs de sigma_sup - sigma_inf")
+    parser.add_argument("--tolerances", nargs="+", type=float, default=[50, 100, 200, 400])
+    parser.add_argument("--last-blur", type=float, default=3.)
+    parser.add_argument("--top", type=int, default=10, help="nombre de jeux de paramètres affichés")
+    args = parser.parse_args()
+
+    images = [cv.imread(filename, cv.IMREAD_ANYDEPTH) for filename in args.images]
+    pairs = [(s, s + d) for s, d in itertools.product(args.sigma_inf, args.sigma_diff)]
+    for result in sweep(images, pairs, args.tolerances, args.last_blur)[:args.top]:
+        print(f"sigma_inf={result['sigma_inf']:g}  sigma_sup={result['sigma_sup']:g}  tolerance={result['tolerance']:g}  "
+              f"score={result['score']:.1f}  composantes stables par image={result['counts']}")
@@ -0,0 +1,147 @@
+# Tests du clustering des translations de registration.py : python -m pytest test_registration.py
+
+import os
+
+import numpy as np
+import cv2 as cv
+import pytest
+
+import registration
+from registration import RegistrationSession, check_options, cluster_translations, find_translation
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# paires d'images fournies et translation attendue (résultat de l'ancienne matrice des distances)
+PAIRS = [
+    ("SE3.tif", "SE2.tif", [43, 31]),
+    ("SE1.tif", "SE5.tif", [-74, -16]),
+    ("SE1.tif", "SE4.tif", [-85, -87]),
+    ("SE2.tif", "SE4.tif", [-61, -55]),
+    ("Nickel/Ref1.tif", "Nickel/ToBeAligned1.tif", [-234, -10]),
+    ("304L/Ref.tif", "304L/ToBeAligned.tif", [71, -24]),
+]
+
+
+def dense_cluster(translations, radius=8):
+    # ancienne implémentation : matrice N x N des distances au carré, puis argmax du nombre de voisins
+    x_trans, y_trans = translations.T
+    dist_squared = (x_trans - x_trans.reshape(-1,1))**2 + (y_trans - y_trans.reshape(-1,1))**2
+    mask = dist_squared < radius**2
+    most_neighbours_index = mask.sum(axis=0).argmax()
+    neighbours = translations[mask[most_neighbours_index]]
+    return neighbours.mean(axis=0).round().astype(np.int32), len(neighbours)
+
+
+def random_translations(rng):
+    n = int(rng.integers(1, 300))
+    kind = rng.integers(4)
+    if kind == 0:
+        # un cluster dans du bruit
+        translations = np.concatenate([rng.normal(rng.uniform(-100, 100, 2), 2, (n // 3 + 1, 2)),
+                                       rng.uniform(-200, 200, (n, 2))])
+    elif kind == 1:
+        # translations entières sur une petite grille : beaucoup de distances égales, d'égalités et de doublons
+        translations = rng.integers(-10, 10, (n, 2)).astype(np.float64)
+    elif kind == 2:
+        # plusieurs clusters de même taille : égalités du nombre de voisins
+        centers = rng.uniform(-100, 100, (3, 2))
+        translations = np.concatenate([center + rng.normal(0, 1, (n // 3 + 1, 2)) for center in centers])
+    else:
+        # cas habituel : une majorité d'inliers dans un cluster serré (tous dans les mêmes cases de la grille)
+        translations = np.concatenate([rng.normal(rng.uniform(-100, 100, 2), 0.5, (2 * n, 2)),
+                                       rng.uniform(-200, 200, (n, 2))])
+    return rng.permutation(translations)
+
+
+@pytest.mark.parametrize("radius", [3, 8, 10.5])
+def test_same_result_as_distance_matrix(radius):
+    rng = np.random.default_rng(int(radius * 10))
+    for _ in range(200):
+        translations = random_translations(rng)
+        translation, size = cluster_translations(translations, radius)
+        expected_translation, expected_size = dense_cluster(translations, radius)
+        assert np.array_equal(translation, expected_translation)
+        assert size == expected_size
+
+
+def test_ties_keep_first_point():
+    # deux clusters de même taille : on garde celui du premier point, comme argmax
+    translations = np.array([[50., 50.], [0., 0.], [51., 50.], [1., 0.]])
+    assert np.array_equal(cluster_translations(translations)[0], [50, 50])
+    assert np.array_equal(cluster_translations(translations[[1, 0, 3, 2]])[0], [0, 0])
+
+
+def test_empty_translations():
+    with pytest.raises(ValueError, match="aucune translation"):
+        cluster_translations(np.zeros((0, 2)))
+
+
+@pytest.mark.parametrize("ref, toTranslate, expected", PAIRS)
+def test_bundled_pairs(ref, toTranslate, expected):
+    translation = find_translation(os.path.join(HERE, ref), os.path.join(HERE, toTranslate))
+    assert np.array_equal(translation, expected)
+
+
+@pytest.mark.parametrize("method, options", [
+    ("phase", dict(radius=3)),
+    ("phase", dict(matcher="flann")),
+    ("pyramid", dict(mask="auto")),
+    ("keyzones", dict(upsample_factor=4)),
+    ("sift", dict(pyramid_levels=3)),
+    ("cascade", dict(confidence="height")),
+    ("cascade", dict(upsample_factor=4)),
+])
+def test_rejects_options_of_other_methods(method, options):
+    with pytest.raises(TypeError, match="sans effet"):
+        check_options(method, options)
+
+
+def test_cascade_passes_each_method_its_options():
+    session = RegistrationSession(os.path.join(HERE, "SE3.tif"), method="cascade", cascade=("phase", "sift"),
+                                  upsample_factor=4, radius=5)
+    assert session.backend.options == {"phase": dict(upsample_factor=4, confidence="ratio"), "sift": dict(radius=5)}
+
+
+@pytest.mark.parametrize("options", [{}, dict(matcher="flann"), dict(max_keypoints=50), dict(tile_size=256),
+                                     dict(method="cascade")])
+def test_featureless_frame(options):
+    # image uniforme : aucun keypoint, l'erreur est celle de cluster_translations (pas une assertion d'OpenCV)
+    ref = cv.imread(os.path.join(HERE, "SE3.tif"), cv.IMREAD_ANYDEPTH)
+    for images in [(ref, np.zeros_like(ref)), (np.zeros_like(ref), ref)]:
+        with pytest.raises(ValueError, match="aucune translation"):
+            find_translation(*images, filenames=False, **options)
+
+
+@pytest.mark.parametrize("options", [{}, dict(matcher="flann"), dict(method="pyramid"), dict(method="keyzones"),
+                                     dict(method="cascade"), dict(method="cascade", cascade=("phase", "sift"))])
+def test_rebase_same_as_new_session(options):
+    # après rebase, la dernière image recalée sert de référence : même résultat qu'une session créée sur elle
+    se2, se4 = os.path.join(HERE, "SE2.tif"), os.path.join(HERE, "SE4.tif")
+    session = RegistrationSession(os.path.join(HERE, "SE3.tif"), **options)
+    session.register(se2)
+    session.rebase()
+    assert np.array_equal(session.register(se4), RegistrationSession(se2, **options).register(se4))
+    with pytest.raises(ValueError, match="aucune image"):
+        RegistrationSession(se2, **options).rebase()
+
+
+def test_cascade_records_skipped_methods():
+    # images de tailles différentes : la corrélation de phase échoue, SIFT prend le relais et l'erreur est gardée
+    ref = cv.imread(os.path.join(HERE, "SE3.tif"), cv.IMREAD_ANYDEPTH)
+    toTranslate = cv.imread(os.path.join(HERE, "SE2.tif"), cv.IMREAD_ANYDEPTH)[:-20]
+    session = RegistrationSession(ref, filenames=False, method="cascade", cascade=("phase", "sift"))
+    translation, diagnostics = session.register(toTranslate, return_diagnostics=True)
+    assert np.array_equal(translation, [43, 31]) and diagnostics.used_method == "sift"
+    assert list(diagnostics.skipped) == ["phase"] and "même taille" in diagnostics.skipped["phase"]
+
+
+
+def test_cascade_does_not_hide_other_errors(monkeypatch):
+    # une erreur qui n'est ni ValueError ni cv.error (bug, ...) remonte au lieu de passer la main à SIFT
+    def broken(self, toTranslate, diagnostics):
+        raise RuntimeError("bug")
+    monkeypatch.setattr(registration.PhaseBackend, "register", broken)
+    session = RegistrationSession(os.path.join(HERE, "SE3.tif"), method="cascade", cascade=("phase", "sift"))
+    with pytest.raises(RuntimeError, match="bug"):
+        session.register(os.path.join(HERE, "SE2.tif"))
@@ -0,0 +1,114 @@
+# Tests de la méthode du motif en croix de Translate.py : python -m pytest test_translate.py
+
+import os
+
+import numpy as np
+import cv2 as cv
+import pytest
+
+import Translate
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+IMAGES = ["SE1.tif", "SE2.tif", "SE3.tif", "SE4.tif", "SE5.tif"]
+
+
+def loop_locate_cross(im, clip=False):
+    # ancienne implémentation : boucle sur les pixels noirs. Sans clip, les fenêtres sont des tranches Python
+    # (indices négatifs près des bords haut et gauche : tranche vide ou repliée) ; avec clip, elles sont coupées au bord.
+    I, J = [], []
+    for i, j in zip(*np.where(im == 0)):
+        low = (lambda k: max(k, 0)) if clip else (lambda k: k)
+        close_neighborhood = im[low(i-1):i+2, low(j-1):j+2]
+        great_neighborhood = im[low(i-6):i+6, low(j-6):j+6]
+        if (close_neighborhood == 0).sum() >= 7 and (great_neighborhood == 0xffff).any():
+            I.append(i)
+            J.append(j)
+    return min(I), max(I), min(J), max(J)
+
+
+def border_cross(shape=(120, 160), seed=0):
+    # croix noire sur fond blanc, coupée par les bords haut et gauche de l'image, dans une image bruitée
+    rng = np.random.default_rng(seed)
+    im = rng.integers(1000, 60000, shape).astype(np.uint16)
+    im[:30, :40] = 0xffff
+    im[:26, 10:16] = 0
+    im[8:14, :34] = 0
+    return im
+
+
+@pytest.mark.parametrize("name", IMAGES)
+def test_same_box_as_pixel_loop(name):
+    im = cv.imread(os.path.join(HERE, name), cv.IMREAD_ANYDEPTH)
+    assert tuple(map(int, Translate.locate_cross(im))) == tuple(map(int, loop_locate_cross(im)))
+
+
+def test_cross_on_top_left_border():
+    # les pixels hors de l'image ne sont ni noirs ni blancs (pas de repliement des indices) : la croix est trouvée
+    # jusqu'à la ligne et la colonne 1 (sur la ligne 0, le carré 3x3 n'a que 6 pixels dans l'image), alors que
+    # l'ancienne boucle, dont les tranches sont vides près du bord, s'arrêtait à 6 pixels du bord
+    im = border_cross()
+    box = tuple(map(int, Translate.locate_cross(im)))
+    assert box == tuple(map(int, loop_locate_cross(im, clip=True)))
+    assert box[0] == 1 and box[2] == 1
+    assert tuple(map(int, loop_locate_cross(im)))[::2] == (6, 6)
+
+
+def direct_distances(A, B, height, width):
+    # distance (norme 1) calculée directement pour chaque position de la sous-image dans B
+    return np.array([[np.abs(A - B[u:u+height, v:v+width]).sum() for v in range(B.shape[1] - width + 1)]
+                     for u in range(B.shape[0] - height + 1)])
+
+
+def ternary_image(rng, shape):
+    # pixels noirs purs, blancs purs ou gris : matrice "comparable" de 1, -1 et 0
+    return rng.choice(np.array([0, 0xffff, 30000], dtype=np.uint16), shape, p=[0.3, 0.3, 0.4])
+
+
+def test_fft_distances_match_direct_sum():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        height, width = rng.integers(3, 30, 2)
+        A = Translate.comparable(ternary_image(rng, (height, width)))
+        B = Translate.comparable(ternary_image(rng, (height + rng.integers(0, 25), width + rng.integers(0, 25))))
+        # identité |a-b| = a²+b²-ab-a²b² et arrondi (rint) des corrélations : égalité exacte
+        assert np.array_equal(Translate.l1_distances(Translate.CrossTemplate(A), B, height, width),
+                              direct_distances(A, B, height, width))
+
+
+@pytest.mark.parametrize("top, left", [(60, 70), (4, 3), (175, 205)])
+def test_optimal_translation_matches_direct_search(top, left):
+    # sans agrandissement de l'intervalle (max_radius = radius), la perturbation retenue est le premier minimum
+    # (ordre des lignes) de la distance calculée directement sur la zone de recherche, coupée au bord de l'image
+    rng = np.random.default_rng(top)
+    im = ternary_image(rng, (200, 240))
+    height, width, radius = 20, 30, 10
+    A = rng.integers(-1, 2, (height, width))
+    search_top, search_left = max(top - radius, 0), max(left - radius, 0)
+    region = Translate.comparable(im[search_top:top + radius + height, search_left:left + radius + width])
+    dist = direct_distances(A, region, height, width)
+    i, j = np.unravel_index(dist.argmin(), dist.shape)
+    assert Translate.optimal_translation(A, height, width, top, left, im, radius=radius, max_radius=radius) \
+        == (search_top + i, search_left + j)
+
+
+def thick_cross(shape, center, half_width=20):
+    # croix noire épaisse sur fond blanc, bras jusqu'aux bords de l'image
+    im = np.full(shape, 0xffff, dtype=np.uint16)
+    im[center[0] - half_width:center[0] + half_width] = 0
+    im[:, center[1] - half_width:center[1] + half_width] = 0
+    return im
+
+
+@pytest.mark.parametrize("shift", [(3, -4), (25, 7), (-18, -30)])
+def test_optimal_translation_grows_radius(shift):
+    # croix du modèle à shift de la première estimation : au-delà de radius = 10 pixels, la meilleure perturbation
+    # est au bord de l'intervalle, qui doit grandir jusqu'à contenir la vraie position
+    height, width, top, left = 60, 80, 100, 120
+    A = Translate.comparable(thick_cross((height, width), (height // 2, width // 2)))
+    im = thick_cross((260, 320), (top + shift[0] + height // 2, left + shift[1] + width // 2))
+    assert Translate.optimal_translation(A, height, width, top, left, im) == (top + shift[0], left + shift[1])
+    if max(map(abs, shift)) > 10:
+        assert Translate.optimal_translation(A, height, width, top, left, im, max_radius=10) \
+            != (top + shift[0], left + shift[1])